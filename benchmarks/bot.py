@@ -0,0 +1,75 @@
+""" Runs the bot the way poll.py or app.py would, but talking to the fake
+services benchmarks.run starts. Not meant to be run by hand.
+
+    python -m benchmarks.bot polling
+    python -m benchmarks.bot webhook <port> """
+
+import os
+import sys
+import asyncio
+import aiohttp
+import uvloop
+
+from urllib.parse import urlsplit
+
+from ofensivaria import config
+from ofensivaria.bot import TelegramBot
+
+UPSTREAM = os.environ['BENCHMARK_UPSTREAM']
+
+
+class RoutingSession(aiohttp.ClientSession):
+    """ Sends every request that isn't for the bot api to the fake upstream,
+    as /<scheme>/<host>/<path> """
+
+    def _request(self, method, url, **kwargs):
+        url = str(url)
+
+        if not url.startswith(config.API_URL):
+            parts = urlsplit(url)
+            url = '%s/%s/%s%s' % (UPSTREAM, parts.scheme, parts.netloc, parts.path or '/')
+
+            if parts.query:
+                url += '?' + parts.query
+
+        return super()._request(method, url, **kwargs)
+
+
+class BenchmarkBot(TelegramBot):
+
+    def create_client(self):
+        return RoutingSession()
+
+
+def polling():
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    bot = BenchmarkBot()
+    loop = asyncio.get_event_loop()
+
+    async def main():
+        await bot.setup()
+        await bot.polling()
+
+    try:
+        loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(bot.cleanup())
+        loop.close()
+
+
+def webhook(port):
+    import ofensivaria.app as web
+
+    # the routes and the startup hooks look the bot up in the module
+    web.bot = BenchmarkBot()
+    web.app.run(host='127.0.0.1', port=port, after_start=[web.startup], after_stop=[web.cleanup])
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'polling':
+        polling()
+    else:
+        webhook(int(sys.argv[2]))
@@ -0,0 +1,520 @@
+""" A small redis stand-in speaking RESP, with just the commands the bot uses.
+
+Lua scripts can't run here, so EVAL looks the script up among the ones the bot
+sends and runs a python version of it. """
+
+import time
+import random
+import asyncio
+
+from collections import Counter
+from fnmatch import fnmatchcase
+
+
+class Status(str):
+    pass
+
+
+class Error(Exception):
+    pass
+
+
+class WrongType(Error):
+
+    def __init__(self):
+        super().__init__('WRONGTYPE Operation against a key holding the wrong kind of value')
+
+
+class ZSet(dict):
+    pass
+
+
+def _score_bound(value, default):
+    value = value.decode()
+
+    if value.startswith('('):
+        return float(value[1:]), True
+
+    return float(value) if value else default, False
+
+
+def _lex_bound(value):
+    if value in (b'-', b'+'):
+        return value, False
+
+    return value[1:], value[:1] == b'('
+
+
+def _encode(value):
+    if value is None:
+        return b'$-1\r\n'
+
+    if isinstance(value, Status):
+        return b'+' + value.encode() + b'\r\n'
+
+    if isinstance(value, Error):
+        return b'-' + str(value).encode() + b'\r\n'
+
+    if isinstance(value, bool):
+        return b':%d\r\n' % int(value)
+
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+
+    if isinstance(value, float):
+        value = repr(value).encode()
+
+    if isinstance(value, str):
+        value = value.encode()
+
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    return b'*%d\r\n' % len(value) + b''.join(_encode(item) for item in value)
+
+
+class FakeRedis:
+    """ Keeps every key in a dict and counts the commands it answers """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.channels = {}
+        self.commands = Counter()
+        self.scripts = {}
+        self._server = None
+
+    @property
+    def total(self):
+        return sum(self.commands.values())
+
+    def script(self, source, function):
+        """ Runs function(redis, keys, args) when someone EVALs source """
+        self.scripts[source.strip()] = function
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self.__serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def __read(self, reader):
+        line = await reader.readline()
+
+        if not line:
+            return None
+
+        if not line.startswith(b'*'):
+            return line.split()
+
+        arguments = []
+
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(size + 2))[:-2])
+
+        return arguments
+
+    async def __serve(self, reader, writer):
+        transaction = None
+
+        try:
+            while True:
+                arguments = await self.__read(reader)
+
+                if arguments is None:
+                    break
+
+                if not arguments:
+                    continue
+
+                name = arguments[0].decode().lower()
+
+                if name == 'subscribe':
+                    for channel in arguments[1:]:
+                        self.channels.setdefault(channel, set()).add(writer)
+                        writer.write(_encode([b'subscribe', channel, 1]))
+                    continue
+
+                if name == 'multi':
+                    transaction = []
+                    reply = Status('OK')
+                elif name == 'exec':
+                    reply = [self.__call(*queued) for queued in transaction or []]
+                    transaction = None
+                elif name == 'discard':
+                    transaction = None
+                    reply = Status('OK')
+                elif transaction is not None:
+                    transaction.append((name, arguments[1:]))
+                    reply = Status('QUEUED')
+                else:
+                    reply = self.__call(name, arguments[1:])
+
+                writer.write(_encode(reply))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for writers in self.channels.values():
+                writers.discard(writer)
+
+            writer.close()
+
+    def __call(self, name, arguments):
+        self.commands[name] += 1
+        method = getattr(self, 'cmd_' + name, None)
+
+        if method is None:
+            return Error("ERR unknown command '%s'" % name)
+
+        try:
+            return method(*arguments)
+        except Error as e:
+            return e
+        except (TypeError, ValueError, IndexError) as e:
+            return Error('ERR %s' % e)
+
+    def __get(self, key, kind=None, create=False):
+        expires = self.expires.get(key)
+
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+        value = self.data.get(key)
+
+        if value is None and create:
+            value = self.data[key] = kind()
+
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise WrongType()
+
+        return value
+
+    def __cleanup(self, key):
+        if not self.data.get(key) and not isinstance(self.data.get(key), bytes):
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    # connection
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else Status('PONG')
+
+    def cmd_select(self, db):
+        return Status('OK')
+
+    def cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return Status('OK')
+
+    def cmd_publish(self, channel, message):
+        writers = self.channels.get(channel, ())
+
+        for writer in writers:
+            writer.write(_encode([b'message', channel, message]))
+
+        return len(writers)
+
+    def cmd_eval(self, script, count, *rest):
+        function = self.scripts.get(script.decode().strip())
+
+        if function is None:
+            return Error('NOSCRIPT the benchmark does not know this script')
+
+        count = int(count)
+        return function(self, list(rest[:count]), list(rest[count:]))
+
+    # keys
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.__get(key) is not None)
+
+    def cmd_del(self, *keys):
+        deleted = self.cmd_exists(*keys)
+
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+        return deleted
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self.data) if self.__get(key) is not None and fnmatchcase(key.decode(), pattern)]
+
+    def cmd_rename(self, key, new):
+        if self.__get(key) is None:
+            return Error('ERR no such key')
+
+        self.data[new] = self.data.pop(key)
+        self.expires.pop(new, None)
+
+        if key in self.expires:
+            self.expires[new] = self.expires.pop(key)
+
+        return Status('OK')
+
+    def cmd_expire(self, key, seconds):
+        if self.__get(key) is None:
+            return 0
+
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_pexpire(self, key, milliseconds):
+        if self.__get(key) is None:
+            return 0
+
+        self.expires[key] = time.time() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_persist(self, key):
+        return int(self.__get(key) is not None and self.expires.pop(key, None) is not None)
+
+    # strings
+
+    def cmd_get(self, key):
+        return self.__get(key, bytes)
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [o.lower() for o in options]
+        expires = None
+
+        if b'nx' in options and self.__get(key) is not None:
+            return None
+
+        if b'xx' in options and self.__get(key) is None:
+            return None
+
+        for unit, scale in ((b'ex', 1), (b'px', 1000)):
+            if unit in options:
+                expires = time.time() + int(options[options.index(unit) + 1]) / scale
+
+        self.data[key] = value
+        self.expires.pop(key, None)
+
+        if expires:
+            self.expires[key] = expires
+
+        return Status('OK')
+
+    def cmd_setex(self, key, seconds, value):
+        return self.cmd_set(key, value, b'ex', seconds)
+
+    def cmd_incr(self, key):
+        value = int(self.__get(key, bytes) or 0) + 1
+        self.data[key] = b'%d' % value
+        return value
+
+    # hashes
+
+    def cmd_hget(self, key, field):
+        return (self.__get(key, dict) or {}).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        values = self.__get(key, dict) or {}
+        return [values.get(field) for field in fields]
+
+    def cmd_hset(self, key, *pairs):
+        values = self.__get(key, dict, create=True)
+        added = 0
+
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+
+        return added
+
+    def cmd_hmset(self, key, *pairs):
+        self.cmd_hset(key, *pairs)
+        return Status('OK')
+
+    def cmd_hdel(self, key, *fields):
+        values = self.__get(key, dict) or {}
+        deleted = sum(1 for field in fields if values.pop(field, None) is not None)
+        self.__cleanup(key)
+        return deleted
+
+    def cmd_hgetall(self, key):
+        return [item for pair in (self.__get(key, dict) or {}).items() for item in pair]
+
+    def cmd_hkeys(self, key):
+        return list(self.__get(key, dict) or ())
+
+    def cmd_hincrby(self, key, field, amount):
+        values = self.__get(key, dict, create=True)
+        value = int(values.get(field, 0)) + int(amount)
+        values[field] = b'%d' % value
+        return value
+
+    def cmd_hincrbyfloat(self, key, field, amount):
+        values = self.__get(key, dict, create=True)
+        value = float(values.get(field, 0)) + float(amount)
+        values[field] = repr(value).encode()
+        return values[field]
+
+    # sets
+
+    def cmd_sadd(self, key, *members):
+        values = self.__get(key, set, create=True)
+        added = len(set(members) - values)
+        values.update(members)
+        return added
+
+    def cmd_srem(self, key, *members):
+        values = self.__get(key, set) or set()
+        removed = len(values & set(members))
+        values.difference_update(members)
+        self.__cleanup(key)
+        return removed
+
+    def cmd_smembers(self, key):
+        return list(self.__get(key, set) or ())
+
+    def cmd_sismember(self, key, member):
+        return int(member in (self.__get(key, set) or ()))
+
+    def cmd_scard(self, key):
+        return len(self.__get(key, set) or ())
+
+    def cmd_srandmember(self, key, count=None):
+        values = list(self.__get(key, set) or ())
+
+        if count is None:
+            return random.choice(values) if values else None
+
+        return random.sample(values, min(len(values), int(count)))
+
+    def cmd_smove(self, source, destination, member):
+        values = self.__get(source, set) or set()
+
+        if member not in values:
+            return 0
+
+        values.discard(member)
+        self.__get(destination, set, create=True).add(member)
+        self.__cleanup(source)
+        return 1
+
+    def cmd_sdiffstore(self, destination, key, *others):
+        values = set(self.__get(key, set) or ())
+
+        for other in others:
+            values -= self.__get(other, set) or set()
+
+        self.data[destination] = values
+        self.__cleanup(destination)
+        return len(values)
+
+    # lists
+
+    def cmd_lpush(self, key, *values):
+        items = self.__get(key, list, create=True)
+
+        for value in values:
+            items.insert(0, value)
+
+        return len(items)
+
+    def cmd_rpush(self, key, *values):
+        items = self.__get(key, list, create=True)
+        items.extend(values)
+        return len(items)
+
+    def cmd_llen(self, key):
+        return len(self.__get(key, list) or ())
+
+    def cmd_lindex(self, key, index):
+        items = self.__get(key, list) or []
+
+        try:
+            return items[int(index)]
+        except IndexError:
+            return None
+
+    def cmd_lrange(self, key, start, stop):
+        items = self.__get(key, list) or []
+        stop = int(stop)
+        return items[int(start):None if stop == -1 else stop + 1]
+
+    # sorted sets
+
+    def cmd_zadd(self, key, *pairs):
+        values = self.__get(key, ZSet, create=True)
+        added = 0
+
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in values
+            values[member] = float(score)
+
+        return added
+
+    def cmd_zrem(self, key, *members):
+        values = self.__get(key, ZSet) or {}
+        removed = sum(1 for member in members if values.pop(member, None) is not None)
+        self.__cleanup(key)
+        return removed
+
+    def cmd_zcard(self, key):
+        return len(self.__get(key, ZSet) or ())
+
+    def __by_score(self, key, low, high):
+        low, low_open = _score_bound(low, float('-inf'))
+        high, high_open = _score_bound(high, float('inf'))
+
+        for member, score in sorted((self.__get(key, ZSet) or {}).items(), key=lambda i: (i[1], i[0])):
+            if (score > low or (score == low and not low_open)) and (score < high or (score == high and not high_open)):
+                yield member
+
+    def cmd_zrange(self, key, start, stop):
+        members = [m for m, _ in sorted((self.__get(key, ZSet) or {}).items(), key=lambda i: (i[1], i[0]))]
+        stop = int(stop)
+        return members[int(start):None if stop == -1 else stop + 1]
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        members = list(self.__by_score(key, low, high))
+        return self.__limit(members, options)
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        values = self.__get(key, ZSet) or {}
+        members = list(self.__by_score(key, low, high))
+
+        for member in members:
+            del values[member]
+
+        self.__cleanup(key)
+        return len(members)
+
+    def cmd_zrangebylex(self, key, low, high, *options):
+        low, low_open = _lex_bound(low)
+        high, high_open = _lex_bound(high)
+        members = []
+
+        for member in sorted(self.__get(key, ZSet) or ()):
+            if low != b'-' and (member < low or (member == low and low_open)):
+                continue
+
+            if high != b'+' and (member > high or (member == high and high_open)):
+                break
+
+            members.append(member)
+
+        return self.__limit(members, options)
+
+    @staticmethod
+    def __limit(members, options):
+        options = list(options)
+
+        if options and options[0].lower() == b'limit':
+            offset, count = int(options[1]), int(options[2])
+            return members[offset:] if count < 0 else members[offset:offset + count]
+
+        return members
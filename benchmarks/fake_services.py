@@ -0,0 +1,231 @@
+""" A fake Bot API and fake versions of the services commands talk to """
+
+import json
+import time
+import asyncio
+import hashlib
+
+from collections import Counter, deque
+
+from aiohttp import web
+
+
+async def _params(request):
+    params = dict(request.GET)
+
+    if request.method == 'POST':
+        params.update(await request.post())
+
+    return params
+
+
+async def serve(app, host='127.0.0.1', port=0):
+    """ Starts an aiohttp app, returns (port, a coroutine function that stops it) """
+    loop = asyncio.get_event_loop()
+    handler = app.make_handler()
+    server = await loop.create_server(handler, host, port)
+
+    async def stop():
+        server.close()
+        await server.wait_closed()
+        await app.shutdown()
+        await handler.shutdown(1)
+        await app.cleanup()
+
+    return server.sockets[0].getsockname()[1], stop
+
+
+class FakeTelegram:
+    """ Hands updates out through getUpdates and takes note of every answer.
+
+    Each update we push says how many messages the bot should send back to its
+    chat. Answers to a chat are matched to its updates in order, so the latency
+    of an update is the time until the first answer to it. """
+
+    SENDS = ('sendMessage', 'sendPhoto', 'sendDocument', 'sendAudio', 'answerInlineQuery')
+
+    def __init__(self, token):
+        self.token = token
+        self.requests = Counter()
+        self.latencies = []
+        self.unexpected = 0
+        self.last_answer = None
+        self.polled = asyncio.Event()
+        self._updates = deque()
+        self._next_id = 1
+        self._waiting = {}
+        self._pending = 0
+        self._arrived = asyncio.Event()
+        self._done = asyncio.Event()
+        self._message_id = 0
+
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot%s/{method}' % token, self.__method)
+        self.app.router.add_route('GET', '/file/bot%s/{path:.*}' % token, self.__file)
+
+    @property
+    def pending(self):
+        """ Answers we still expect """
+        return self._pending
+
+    @property
+    def total(self):
+        return sum(count for method, count in self.requests.items() if method != 'getUpdates')
+
+    def expect(self, chat_id, answers, sent=None):
+        """ Waits for `answers` messages to the chat for an update sent at `sent` """
+        if answers:
+            self._waiting.setdefault(chat_id, deque()).append([sent or time.monotonic(), answers, False])
+            self._pending += answers
+            self._done.clear()
+
+    def next_update_id(self):
+        update_id = self._next_id
+        self._next_id += 1
+        return update_id
+
+    def push(self, update, chat_id, answers):
+        """ Queues the update for getUpdates """
+        update['update_id'] = self.next_update_id()
+        self.expect(chat_id, answers)
+        self._updates.append(update)
+        self._arrived.set()
+
+    def answered(self, chat_id):
+        self.last_answer = time.monotonic()
+        waiting = self._waiting.get(chat_id)
+
+        if not waiting:
+            self.unexpected += 1
+            return
+
+        entry = waiting[0]
+
+        # the first answer is the one the user waits for
+        if not entry[2]:
+            self.latencies.append(time.monotonic() - entry[0])
+            entry[2] = True
+
+        entry[1] -= 1
+        self._pending -= 1
+
+        if not entry[1]:
+            waiting.popleft()
+
+        if not self._pending:
+            self._done.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __get_updates(self, params):
+        self.polled.set()
+        offset = int(params.get('offset') or 0)
+
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+
+        if not self._updates and params.get('timeout'):
+            self._arrived.clear()
+
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params['timeout']))
+            except asyncio.TimeoutError:
+                pass
+
+        return [u for u, _ in zip(self._updates, range(int(params.get('limit') or 100)))]
+
+    def __message(self, params, **extra):
+        self._message_id += 1
+        chat_id = int(params.get('chat_id', 0))
+        message = dict(message_id=self._message_id, date=int(time.time()), chat=dict(id=chat_id, type='group'))
+        message.update(extra)
+        return message
+
+    @staticmethod
+    def __file_id(value):
+        if not value.startswith('http'):
+            return value
+
+        return 'AgAD' + hashlib.sha1(value.encode()).hexdigest()
+
+    async def __method(self, request):
+        method = request.match_info['method']
+        params = await _params(request)
+        self.requests[method] += 1
+
+        if method == 'getUpdates':
+            result = await self.__get_updates(params)
+        elif method == 'getMe':
+            result = dict(id=1, is_bot=True, username='ofensivaria_bot', first_name='ofensivaria')
+        elif method == 'getFile':
+            result = dict(file_id=params.get('file_id'), file_path='photos/%s.jpg' % params.get('file_id'))
+        elif method == 'getWebhookInfo':
+            result = dict(url='', pending_update_count=len(self._updates))
+        elif method == 'sendPhoto':
+            photo = self.__file_id(params['photo'])
+            result = self.__message(params, photo=[dict(file_id=photo + '_s'), dict(file_id=photo)])
+        elif method == 'sendDocument':
+            result = self.__message(params, document=dict(file_id=self.__file_id(params['document'])))
+        elif method == 'answerInlineQuery':
+            result = True
+        elif method.startswith('send'):
+            result = self.__message(params, text=params.get('text'))
+        else:
+            result = True
+
+        if method in self.SENDS:
+            self.answered(int(params.get('chat_id') or params.get('inline_query_id', '0').split(':')[0]))
+
+        return web.json_response(dict(ok=True, result=result))
+
+    async def __file(self, request):
+        self.requests['file'] += 1
+        return web.Response(body=b'\xff\xd8\xff' + hashlib.sha1(request.match_info['path'].encode()).digest() * 64,
+                            content_type='image/jpeg')
+
+
+class FakeUpstream:
+    """ Answers for every other service, by host. The bot reaches it at
+    /<scheme>/<host>/<path> """
+
+    RESPONSES = {
+        'api.scryfall.com': dict(image_uris=dict(large='https://img.scryfall.com/cards/large/benchmark.jpg'),
+                                 scryfall_uri='https://scryfall.com/card/benchmark', name='Benchmark', usd='0.10'),
+        'pe-api.herokuapp.com': dict(message='It works on my machine'),
+        'archive.org': dict(archived_snapshots=dict(closest=dict(url='http://web.archive.org/web/benchmark'))),
+        'api.coinmarketcap.com': [dict(symbol='BTC', price_brl='30000.0'), dict(symbol='ETH', price_brl='2000.0')],
+        'api.fixer.io': dict(rates=dict(BRL=4.0)),
+        'horaro.org': dict(data=dict(ticker=dict(current=None, next=None), schedule=dict(link='https://horaro.org/'))),
+        'www.google.com.br': dict(),
+        'api.imgur.com': dict(success=True, data=dict(link='https://i.imgur.com/benchmark.jpg')),
+    }
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = Counter()
+        self.app = web.Application()
+        self.app.router.add_route('*', '/{scheme}/{host}/{path:.*}', self.__answer)
+
+    @property
+    def total(self):
+        return sum(self.requests.values())
+
+    async def __answer(self, request):
+        host = request.match_info['host']
+        self.requests[host] += 1
+
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        if host == 'yugiohprices.com':
+            return web.Response(status=302, headers={'Location': 'https://static.benchmark/card.jpg'})
+
+        # like imgur, only take the image as a file of a multipart form
+        if host == 'api.imgur.com' and not getattr((await request.post()).get('image'), 'filename', None):
+            return web.json_response(dict(success=False, status=400, data=dict(error='No image')), status=400)
+
+        return web.Response(text=json.dumps(self.RESPONSES.get(host, {})), content_type='application/json')
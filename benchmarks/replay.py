@@ -0,0 +1,42 @@
+""" Reads the updates the traffic recorder or benchmarks.synthetic wrote, for
+benchmarks.run --replay """
+
+import json
+
+
+def load(path, limit=None):
+    """ Returns [(seconds since the first update, update, chat to expect answers
+    on, answers)] in time order """
+    entries = []
+
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+
+            if line:
+                entries.append(json.loads(line))
+
+            if limit and len(entries) >= limit:
+                break
+
+    entries.sort(key=lambda e: e['t'])
+    start = entries[0]['t'] if entries else 0
+    updates = []
+
+    for i, entry in enumerate(entries):
+        update = entry['update']
+        update.pop('update_id', None)
+        inline_query = update.get('inline_query')
+
+        if inline_query:
+            # the fake api finds who to credit the answer to in the query id
+            chat_id = inline_query['from']['id']
+            inline_query['id'] = '%s:%s' % (chat_id, i)
+        elif 'message' in update:
+            chat_id = update['message']['chat']['id']
+        else:
+            chat_id = 0
+
+        updates.append((entry['t'] - start, update, chat_id, entry.get('answers', 0)))
+
+    return updates
@@ -0,0 +1,360 @@
+""" Runs the bot in a child process against a fake Bot API, fake upstream
+services and a fake redis served from this one, and measures how fast it
+answers.
+
+    python -m benchmarks.run --mode both --updates 2000
+
+With --replay, it sends the updates of a file the traffic recorder
+(RECORD_PATH) or benchmarks.synthetic wrote instead, as fast as possible or,
+with --speed, at their original pace.
+
+Every run is appended to the results file and compared to the last run with
+the same parameters. Nothing here touches the network. """
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import aiohttp
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks import replay, workload
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_services import FakeTelegram, FakeUpstream, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '123:benchmark'
+
+# lower is better for everything but these
+HIGHER_IS_BETTER = ('updates_per_second', 'answered')
+
+
+def register_scripts(redis):
+    """ Python versions of the lua scripts the bot EVALs """
+    from ofensivaria.updates import UpdateStore
+    from ofensivaria.scheduler import Scheduler
+    from ofensivaria.commands import MessageToGif
+
+    def set_max(r, keys, args):
+        if int(args[0]) > int(r.cmd_get(keys[0]) or 0):
+            r.cmd_set(keys[0], args[0])
+
+    def release(r, keys, args):
+        return r.cmd_del(keys[0]) if r.cmd_get(keys[0]) == args[0] else 0
+
+    def random_gif(r, keys, args):
+        size = r.cmd_llen(keys[0])
+        return r.cmd_lindex(keys[0], int(args[0]) % size) if size else None
+
+    redis.script(UpdateStore.SET_MAX_SCRIPT, set_max)
+    redis.script(Scheduler.RELEASE_SCRIPT, release)
+    redis.script(MessageToGif.RANDOM_SCRIPT, random_gif)
+
+
+def seed(redis):
+    redis.cmd_set(b'bot:imgur:client', b'benchmark')
+
+    for name in workload.GIFS:
+        redis.cmd_sadd(b'bot:gifs', name.encode())
+        redis.cmd_lpush(b'bot:gifs:' + name.encode(), b'https://media.benchmark/%s.gif' % name.encode())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class Benchmark:
+
+    def __init__(self, args, mode):
+        self.args = args
+        self.mode = mode
+        self.redis = FakeRedis()
+        self.telegram = FakeTelegram(TOKEN)
+        self.upstream = FakeUpstream(args.upstream_delay)
+        self._stops = []
+        self._process = None
+
+    async def __start_services(self):
+        register_scripts(self.redis)
+        seed(self.redis)
+        redis_port = await self.redis.start()
+        self._stops.append(self.redis.close)
+
+        telegram_port, stop = await serve(self.telegram.app)
+        self._stops.append(stop)
+        upstream_port, stop = await serve(self.upstream.app)
+        self._stops.append(stop)
+
+        return dict(
+            TOKEN=TOKEN,
+            DEBUG='0',
+            LOGGING_LEVEL=self.args.logging,
+            API_URL='http://127.0.0.1:%s' % telegram_port,
+            BENCHMARK_UPSTREAM='http://127.0.0.1:%s' % upstream_port,
+            REDIS_HOST='127.0.0.1',
+            REDIS_PORT=str(redis_port),
+            WORKERS=str(self.args.workers),
+            RATE_LIMIT='1' if self.args.rate_limit else '0',
+            LONG_POLLING_TIMEOUT='10',
+            MARKOV_PATH=tempfile.mkdtemp(prefix='benchmark-markov-'),
+            QUOTE_WORKERS='0',
+        )
+
+    async def __start_bot(self, env):
+        command = [sys.executable, '-m', 'benchmarks.bot', self.mode]
+
+        if self.mode == 'webhook':
+            self.port = free_port()
+            command.append(str(self.port))
+
+        self._process = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **env))
+
+        if self.mode == 'polling':
+            await asyncio.wait_for(self.telegram.polled.wait(), self.args.timeout)
+            return
+
+        deadline = time.monotonic() + self.args.timeout
+
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                writer.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self._process.poll() is not None:
+                    raise RuntimeError('The bot did not start')
+
+                await asyncio.sleep(0.1)
+
+    async def __pace(self, i, at, start):
+        if at is not None and self.args.speed:
+            delay = start + at / self.args.speed - time.monotonic()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif self.args.rate:
+            delay = start + i / self.args.rate - time.monotonic()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def __poll_load(self, updates):
+        start = time.monotonic()
+
+        for i, (at, update, chat_id, answers) in enumerate(updates):
+            await self.__pace(i, at, start)
+            self.telegram.push(update, chat_id, answers)
+
+    async def __webhook_load(self, updates):
+        url = 'http://127.0.0.1:%s/telegram?token=%s' % (self.port, TOKEN)
+        connector = aiohttp.TCPConnector(limit=self.args.connections)
+        slots = asyncio.Semaphore(self.args.connections)
+        start = time.monotonic()
+
+        async def deliver(update, chat_id, answers):
+            try:
+                update['update_id'] = self.telegram.next_update_id()
+                self.telegram.expect(chat_id, answers)
+
+                while True:
+                    async with session.post(url, data=json.dumps(update),
+                                            headers={'Content-Type': 'application/json'}) as response:
+                        # like telegram, try again later when the bot is busy
+                        if response.status == 503:
+                            await asyncio.sleep(0.1)
+                            continue
+
+                        body = await response.text()
+
+                    if body.startswith('{') and 'method' in json.loads(body):
+                        self.telegram.answered(chat_id)
+
+                    return
+            finally:
+                slots.release()
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = []
+
+            for i, (at, update, chat_id, answers) in enumerate(updates):
+                await self.__pace(i, at, start)
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(deliver(update, chat_id, answers)))
+
+            await asyncio.gather(*tasks)
+
+    async def run(self):
+        try:
+            await self.__start_bot(await self.__start_services())
+
+            # startup jobs, like fetching coin prices, shouldn't count
+            await asyncio.sleep(self.args.warm_up)
+
+            if self.args.replay:
+                updates = replay.load(self.args.replay, self.args.updates)
+            else:
+                updates = list(workload.generate(self.args.updates, self.args.chats, self.args.mix, self.args.seed))
+
+            redis, telegram, upstream = self.redis.total, self.telegram.total, self.upstream.total
+            redis_commands = self.redis.commands.copy()
+            start = time.monotonic()
+
+            if self.mode == 'polling':
+                await self.__poll_load(updates)
+            else:
+                await self.__webhook_load(updates)
+
+            sent = time.monotonic()
+            await self.telegram.wait(self.args.timeout)
+
+            # waiting out the timeout for answers that never come isn't work
+            elapsed = max(sent, self.telegram.last_answer or sent) - start
+        finally:
+            await self.close()
+
+        count = len(updates)
+        latencies = self.telegram.latencies
+        outbound = self.telegram.total - telegram + self.upstream.total - upstream
+        per_command = self.redis.commands - redis_commands
+
+        return dict(
+            updates=count,
+            answered=len(latencies),
+            missing=self.telegram.pending,
+            seconds=round(elapsed, 3),
+            updates_per_second=round(count / elapsed, 1),
+            p50_ms=round(percentile(latencies, .5) * 1000, 2) if latencies else None,
+            p99_ms=round(percentile(latencies, .99) * 1000, 2) if latencies else None,
+            redis_per_update=round((self.redis.total - redis) / count, 2),
+            outbound_per_update=round(outbound / count, 2),
+            redis_commands={k: round(v / count, 2) for k, v in per_command.most_common(8)},
+        )
+
+    async def close(self):
+        if self._process and self._process.poll() is None:
+            self._process.send_signal(signal.SIGINT)
+
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._process.wait, 15)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+        for stop in reversed(self._stops):
+            await stop()
+
+
+def params(args, mode):
+    if args.replay:
+        return dict(mode=mode, replay=os.path.abspath(args.replay), updates=args.updates, speed=args.speed,
+                    rate=args.rate, workers=args.workers, connections=args.connections,
+                    upstream_delay=args.upstream_delay, rate_limit=args.rate_limit)
+
+    return dict(mode=mode, updates=args.updates, chats=args.chats, mix=args.mix, rate=args.rate,
+                workers=args.workers, connections=args.connections, upstream_delay=args.upstream_delay,
+                rate_limit=args.rate_limit, seed=args.seed)
+
+
+def previous(path, run_params):
+    last = None
+
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+
+                if entry['params'] == run_params and not entry.get('incomplete'):
+                    last = entry
+
+    return last
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(mode, results, last):
+    print('\n%s: %s updates in %ss' % (mode, results['updates'], results['seconds']))
+
+    if results['missing']:
+        print('  INCOMPLETE, %s answers never came. not compared to or with other runs' % results['missing'])
+        last = None
+
+    for key, value in results.items():
+        if key in ('updates', 'seconds', 'redis_commands'):
+            continue
+
+        line = '  %-22s %s' % (key, value)
+        before = last and last['results'].get(key)
+
+        if isinstance(value, (int, float)) and before:
+            change = (value - before) / before * 100
+            better = (change > 0) == (key in HIGHER_IS_BETTER)
+            line += '  (%+.1f%% from %s at %s%s)' % (change, before, last.get('commit'),
+                                                    '' if abs(change) < 5 else ', better' if better else ', WORSE')
+
+        print(line)
+
+    print('  redis commands per update: %s' % results['redis_commands'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('polling', 'webhook', 'both'), default='both')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--mix', default=workload.DEFAULT_MIX,
+                        help='kinds of updates and their weights, from %s' % ', '.join(sorted(workload.KINDS)))
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 sends them all at once')
+    parser.add_argument('--replay', help='a file of recorded or synthetic updates to send instead of the mix. '
+                                         '--updates caps how many of them')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='with --replay, 1 keeps the original pace, 2 is twice as fast and 0 ignores it')
+    parser.add_argument('--workers', type=int, default=8, help='the WORKERS setting of the bot')
+    parser.add_argument('--connections', type=int, default=40, help='concurrent webhook deliveries')
+    parser.add_argument('--upstream-delay', type=float, default=0.02, help='seconds the fake upstreams take')
+    parser.add_argument('--rate-limit', action='store_true', help="keep the bot's outgoing rate limits on")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--warm-up', type=float, default=2)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--logging', default='WARNING', help='the LOGGING_LEVEL of the bot')
+    parser.add_argument('--results', default=os.path.join(ROOT, 'benchmarks', 'results.jsonl'))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workload.parse_mix(args.mix)
+    modes = ('polling', 'webhook') if args.mode == 'both' else (args.mode,)
+    loop = asyncio.get_event_loop()
+
+    for mode in modes:
+        results = loop.run_until_complete(Benchmark(args, mode).run())
+        run_params = params(args, mode)
+        report(mode, results, previous(args.results, run_params))
+
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=commit(), params=run_params,
+                                    results=results, incomplete=results['missing'] > 0)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+""" Writes a synthetic workload in the format the traffic recorder uses, for
+benchmarks.run --replay.
+
+    python -m benchmarks.synthetic --updates 5000 --chats 200 --mix ping=3,quote=1,text=20 > workload.jsonl
+
+Slash commands come from the command entry points in setup.py, so every
+command the bot loads can be in the mix, by entry point name (every slash
+command of it) or by slash command (/randomgif). Chats talk in bursts: how
+often a chat has a burst follows a power law of its rank, so a few chats are
+busy and most are quiet. """
+
+import sys
+import json
+import math
+import heapq
+import random
+import argparse
+
+from stevedore import extension
+
+from benchmarks import workload
+
+# they change the bot's data, take long, are for admins or never answer
+# (there's no send_audio for /sandstorm)
+EXCLUDED = ('/teach', '/forget', '/imgurid', '/downloadcards', '/profile', '/sandstorm')
+
+# messages the bot sends for each, one when it isn't here
+ANSWERS = {'/mtg': 2}
+
+ARGUMENTS = {
+    'value': lambda r: str(r.randint(1, 100)),
+    'symbol': lambda r: r.choice(('BTC', 'ETH', 'USD', 'EUR')),
+    'url': lambda r: 'http://example.com/%d' % r.randint(1, 1000),
+    'name': lambda r: r.choice(workload.GIFS),
+    'question': lambda r: ' '.join(r.choice(workload.WORDS) for _ in range(r.randint(2, 8))) + '?',
+}
+
+
+def slash_commands():
+    """ {entry point name: [slash command templates]} for every command """
+    manager = extension.ExtensionManager(namespace='ofensivaria.bot.commands')
+    commands = {}
+
+    for ext in manager:
+        slash = ext.plugin.SLASH_COMMAND
+
+        # commands with a REGEX only answer what matches it, like /8ball
+        if ext.plugin.REGEX:
+            continue
+
+        if isinstance(slash, str):
+            slash = [slash]
+
+        commands[ext.name] = [s for s in slash or () if s.split()[0] not in EXCLUDED]
+
+    return {name: templates for name, templates in commands.items() if templates}
+
+
+def fill(template, rng, words):
+    """ '/convert [value] [symbol]' -> '/convert 42 BTC' """
+    parts = template.split()
+
+    for i, part in enumerate(parts[1:], 1):
+        name = part.strip('[]')
+        parts[i] = ARGUMENTS[name](rng) if name in ARGUMENTS else words()
+
+    return ' '.join(parts)
+
+
+class Synthesizer:
+
+    def __init__(self, mix, chats, burst, burst_gap, gap, skew, words, seed=1):
+        self.rng = random.Random(seed)
+        self.chats = chats
+        self.burst = burst
+        self.burst_gap = burst_gap
+        self.gap = gap
+        self.skew = skew
+        self.words = words
+        self.templates, self.weights = self.__mix(mix)
+
+    @staticmethod
+    def __mix(mix):
+        commands = slash_commands()
+        templates, weights = [], []
+
+        if not mix:
+            mix = ','.join('%s=1' % name for name in commands) + ',text=4'
+
+        for part in mix.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+            weight = float(weight or 1)
+
+            if name == 'text':
+                choices = [None]
+            elif name.startswith('/'):
+                choices = [t for templates in commands.values() for t in templates if t.split()[0] == name]
+            else:
+                choices = commands.get(name, [])
+
+            if not choices:
+                raise ValueError('Nothing to send for %r, pick from text, %s' % (name, ', '.join(sorted(commands))))
+
+            for template in choices:
+                templates.append(template)
+                weights.append(weight / len(choices))
+
+        return templates, weights
+
+    def __words(self):
+        # lognormal, with self.words as the mean
+        sigma = 0.8
+        count = max(1, int(round(self.rng.lognormvariate(math.log(self.words) - sigma ** 2 / 2, sigma))))
+        return ' '.join(self.rng.choice(workload.WORDS) for _ in range(count))
+
+    def __text(self):
+        template = self.rng.choices(self.templates, self.weights)[0]
+
+        if template is None:
+            return self.__words(), 0
+
+        return fill(template, self.rng, self.__words), ANSWERS.get(template.split()[0], 1)
+
+    def __gap(self, rank):
+        return self.rng.expovariate(1 / (self.gap * (rank + 1) ** self.skew))
+
+    def generate(self, count):
+        """ Yields recorder entries, in time order """
+        bursts = [(self.__gap(rank), rank) for rank in range(self.chats)]
+        heapq.heapify(bursts)
+        pending = []
+        emitted = 0
+
+        while emitted < count:
+            start, rank = heapq.heappop(bursts)
+
+            # everything before this burst is final now
+            while pending and pending[0][0] <= start:
+                yield heapq.heappop(pending)[2]
+
+            at = start
+            size = 1 + int(self.rng.expovariate(1 / (self.burst - 1))) if self.burst > 1 else 1
+
+            for _ in range(min(size, count - emitted)):
+                emitted += 1
+                text, answers = self.__text()
+                message = workload.message(-1000 - rank, self.rng.randrange(1, 4) + rank * 3, emitted, text)
+                entry = dict(t=round(at, 3), update=dict(update_id=emitted, message=message), answers=answers)
+                heapq.heappush(pending, (at, emitted, entry))
+                at += self.rng.expovariate(1 / self.burst_gap)
+
+            heapq.heappush(bursts, (at + self.__gap(rank), rank))
+
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--mix', default='', help='weights by entry point, /command or text. every command by default')
+    parser.add_argument('--burst', type=float, default=3, help='mean messages per burst')
+    parser.add_argument('--burst-gap', type=float, default=2, help='mean seconds between messages of a burst')
+    parser.add_argument('--gap', type=float, default=60, help='mean seconds between bursts of the busiest chat')
+    parser.add_argument('--skew', type=float, default=1, help='how much quieter each less busy chat is')
+    parser.add_argument('--words', type=float, default=6, help='mean words per message')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    synthesizer = Synthesizer(args.mix, args.chats, args.burst, args.burst_gap, args.gap, args.skew, args.words,
+                              args.seed)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    try:
+        for entry in synthesizer.generate(args.updates):
+            output.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" The updates a benchmark sends, and how many answers each one should get """
+
+import time
+import random
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua').split()
+
+# gifs the benchmark teaches the bot before starting
+GIFS = ['bench%02d' % i for i in range(50)]
+
+# name: (a function returning the text, how many messages the bot answers with)
+KINDS = {
+    'ping': (lambda r: '/ping', 1),
+    'flip': (lambda r: '/flip', 1),
+    'shrug': (lambda r: '/shrug', 1),
+    'help': (lambda r: '/help', 1),
+    'square': (lambda r: '/square ' + r.choice(WORDS), 1),
+    'gifs': (lambda r: '/gifs bench', 1),
+    'randomgif': (lambda r: '/randomgif', 1),
+    'gif': (lambda r: r.choice(GIFS) + '.gif', 1),
+    'excuse': (lambda r: '/excuse', 1),
+    'archive': (lambda r: '/archive http://example.com/%d' % r.randint(1, 20), 1),
+    'convert': (lambda r: '/convert 1 BTC', 1),
+    'mtg': (lambda r: '/mtg', 2),
+    'text': (lambda r: ' '.join(r.choice(WORDS) for _ in range(r.randint(1, 12))), 0),
+    'inline': (lambda r: 'bench', 1),
+    # a photo sent in private, which goes to imgur. the text is its file_id
+    'photo': (lambda r: 'AgADbench%02d' % r.randrange(20), 1),
+}
+
+DEFAULT_MIX = 'ping=3,flip=1,square=1,gifs=1,randomgif=2,gif=2,excuse=1,archive=1,convert=1,mtg=1,text=8,inline=1,photo=1'
+
+
+def parse_mix(mix):
+    """ 'ping=3,text=1' -> {'ping': 3.0, 'text': 1.0} """
+    weights = {}
+
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+
+        if name not in KINDS:
+            raise ValueError('Unknown kind %r, pick from %s' % (name, ', '.join(sorted(KINDS))))
+
+        weights[name] = float(weight or 1)
+
+    return weights
+
+
+def message(chat_id, user_id, message_id, text):
+    return dict(message_id=message_id, date=int(time.time()), text=text,
+                chat=dict(id=chat_id, type='group', title='benchmark %s' % chat_id),
+                **{'from': dict(id=user_id, first_name='user%s' % user_id, is_bot=False)})
+
+
+def generate(count, chats, mix=DEFAULT_MIX, seed=1):
+    """ Yields (None, update without an update_id, chat to expect answers on,
+    answers). The first item is when to send it, like replay.load, but these go
+    out as fast as benchmarks.run --rate allows """
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    kinds = list(weights)
+    cumulative = [weights[k] for k in kinds]
+
+    for i in range(count):
+        kind = rng.choices(kinds, cumulative)[0]
+        text_for, answers = KINDS[kind]
+        chat_id = -1000 - rng.randrange(chats)
+        user_id = rng.randrange(1, chats * 3 + 1)
+        text = text_for(rng)
+
+        if kind == 'inline':
+            # inline answers aren't sent to a chat, the fake api reads the user from the query id
+            query = {'id': '%s:%s' % (user_id, i), 'query': text, 'offset': '',
+                     'from': dict(id=user_id, first_name='user%s' % user_id, is_bot=False)}
+            yield None, {'inline_query': query}, user_id, answers
+        elif kind == 'photo':
+            photo = message(user_id, user_id, i + 1, None)
+            photo['chat']['type'] = 'private'
+            del photo['text']
+            photo['photo'] = [dict(file_id=text, width=1280, height=720, file_size=200 * 1024)]
+            yield None, {'message': photo}, user_id, answers
+        else:
+            yield None, {'message': message(chat_id, user_id, i + 1, text)}, chat_id, answers
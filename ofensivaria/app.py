@@ -1,17 +1,23 @@
+import asyncio
 import logging
 
+from urllib.parse import urlsplit
+
 from sanic import Sanic
 from sanic.views import HTTPMethodView
-from sanic.response import text
+from sanic.response import text, json
 
-from ofensivaria import config
-from ofensivaria.bot import TelegramBot
+from ofensivaria import config, metrics
+from ofensivaria.bot import TelegramBot, WebhookReply
 
 logging.basicConfig()
 
 app = Sanic()
 bot = TelegramBot()
 
+# updates being processed while their webhook waits for the reply
+processing = set()
+
 
 async def cleanup(*args):
     await bot.cleanup()
@@ -21,10 +27,21 @@ async def startup(*args):
     await bot.setup()
 
 
+def processed(task):
+    processing.discard(task)
+
+    if not task.cancelled() and task.exception():
+        logging.error('Could not process an update', exc_info=task.exception())
+
+
 @app.middleware('request')
 def validate_token(request):
     token = request.args.get('token', None)
 
+    # sanic 0.1.9 gives the path as the url, newer ones the whole target
+    if config.METRICS_TOKEN and urlsplit(request.url).path == '/metrics' and token == config.METRICS_TOKEN:
+        return
+
     if not config.DEBUG and token != config.TOKEN:
         logging.error('Got a request from outside telegram. Watchout!')
         return text(':)')
@@ -38,12 +55,35 @@ class TelegramRoute(HTTPMethodView):
         commands = [(c.split(' ')[0][1:], c) for c in bot.get_slash_commands()]
         commands = '\n'.join([f'{c} - {d}' for c, d in sorted(commands)])
 
-        return text("Hello! My name is {} and my webhook info is {}.\n\n my commands are \n{}".format(me['result']['username'], str(info), commands))
+        return text("Hello! My name is {} and my webhook info is {}.\n\n my commands are \n{}\n\nqueue: {}\n\njobs: {}".format(
+            me['result']['username'], str(info), commands, bot.queue_stats(), bot.scheduler.stats()))
 
     async def post(self, request):
         logging.info('%s %s %s', request.url, request.method, request.json)
         update = request.json
-        await bot.process_update(update)
+
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return text("invalid update", status=400)
+
+        reply = WebhookReply.attach(update) if config.INLINE_REPLIES else None
+
+        if bot.workers:
+            if not await bot.enqueue_update(update):
+                # telegram will try to deliver it again later
+                return text("busy", status=503)
+        elif reply:
+            task = asyncio.ensure_future(bot.process_update(update))
+            task.add_done_callback(processed)
+            processing.add(task)
+        else:
+            await bot.process_update(update)
+
+        if reply:
+            payload = await reply.wait(config.INLINE_REPLY_TIMEOUT)
+
+            if payload:
+                return json(payload)
+
         return text("ok")
 
     async def put(self, request):
@@ -53,5 +93,24 @@ class TelegramRoute(HTTPMethodView):
 
 app.add_route(TelegramRoute(), '/telegram')
 
+
+@app.route('/profile', methods=['PUT', 'DELETE'])
+async def profile_route(request):
+    """ PUT starts the profiler, DELETE stops it and says where the stacks are """
+    # unlike the other routes, this one always needs the token
+    if request.args.get('token', None) != config.TOKEN:
+        return text(':)', status=403)
+
+    if request.method == 'PUT':
+        return json(dict(started=bot.profiler.start()))
+
+    return json(dict(path=bot.profiler.stop()))
+
+
+@app.route('/metrics')
+async def metrics_route(request):
+    return text(metrics.REGISTRY.render())
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8000, after_start=[startup], after_stop=[cleanup], debug=config.DEBUG)
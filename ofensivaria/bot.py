@@ -1,4 +1,7 @@
 import io
+import json
+import time
+import random
 import asyncio
 import aiohttp
 import aioredis
@@ -6,22 +9,99 @@ import logging
 
 from itertools import chain
 
-from ofensivaria import config
+from ofensivaria import config, metrics
+from ofensivaria.cache import MediaCache, ResponseCache
+from ofensivaria.dispatcher import CommandDispatcher
+from ofensivaria.outbox import Outbox, NORMAL, LOW
+from ofensivaria.profiling import LoopMonitor, SamplingProfiler
+from ofensivaria.recorder import TrafficRecorder
+from ofensivaria.scheduler import Scheduler
+from ofensivaria.updates import UpdateStore
+from ofensivaria.workers import ChatWorkerPool
 from stevedore import extension
 
 logging.basicConfig(format='%(asctime)s:%(levelname)s:%(name)s: %(message)s',
                     level=logging.INFO)
 
 
+class TelegramApiError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class WebhookReply:
+    """ Keeps the first answer to a webhook update, so it goes back to telegram
+    in the webhook response instead of in a request of its own. Anything sent
+    after that, or after the webhook stopped waiting, goes out as usual """
+
+    # form encoded as 'true' or 'false', but booleans in json
+    FLAGS = ('disable_web_page_preview', 'disable_notification')
+
+    def __init__(self):
+        self.payload = None
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    @classmethod
+    def attach(cls, update):
+        message = update.get('message')
+
+        if not message:
+            return None
+
+        reply = message['webhook_reply'] = cls()
+        return reply
+
+    @staticmethod
+    def release(update):
+        reply = (update.get('message') or {}).pop('webhook_reply', None)
+
+        if reply:
+            reply.close()
+
+    def offer(self, method, data):
+        if self.closed or self.payload is not None:
+            return False
+
+        # this is sent as json, so the form encoded flags become real booleans
+        self.payload = {k: v == 'true' if k in self.FLAGS else v for k, v in data.items()}
+        self.payload['method'] = method
+        self.ready.set()
+        return True
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        return self.payload
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.close()
+
+
 class TelegramBot:
 
     def __init__(self):
         self._repolling = 4
         self._redis = None
-        self._url = 'https://api.telegram.org/bot{}'.format(config.TOKEN)
-        self._file_url = 'https://api.telegram.org/file/bot{}/'.format(config.TOKEN)
+        self.workers = None
+        self.outbox = None
+        self.http_cache = None
+        self.media_cache = None
+        self.monitor = None
+        self.recorder = None
+        self.profiler = SamplingProfiler(config.PROFILE_INTERVAL, config.PROFILE_DIR)
+        self.scheduler = None
+        self._url = '{}/bot{}'.format(config.API_URL, config.TOKEN)
+        self._file_url = '{}/file/bot{}/'.format(config.API_URL, config.TOKEN)
         self.__setup = False
-        self.__processed_status = set()
+        self.updates = None
         self.__logger = logging.getLogger('telegram-bot')
         self.__logger.setLevel(config.LOGGING_LEVEL)
 
@@ -29,9 +109,9 @@ class TelegramBot:
     def was_initialized(self):
         return self.__setup
 
-    async def __request(self, path, method="get", data=None, headers=None):
+    async def __request(self, path, method="get", data=None, headers=None, timeout=30):
         url = "{}/{}".format(self._url, path)
-        kwargs = {'timeout': 30}
+        kwargs = {'timeout': timeout}
 
         if headers:
             kwargs['headers'] = headers
@@ -43,22 +123,60 @@ class TelegramBot:
                 kwargs.update({'data': data})
 
         self.__logger.debug('Sending a %s request to %s with args %s', method, url, kwargs)
-        async with self.client.request(method, url, **kwargs) as response:
-            self.__logger.debug('Got response %s', response)
-            response = await response.json()
-            self.__logger.debug('Got json %s', response)
-            return response
+        start = time.monotonic()
+        outcome = 'error'
+
+        try:
+            async with self.client.request(method, url, **kwargs) as response:
+                self.__logger.debug('Got response %s', response)
+                outcome = str(response.status)
+
+                if response.status >= 500:
+                    raise TelegramApiError(response.status, 'Telegram answered {} to {}'.format(response.status, path))
+
+                response = await response.json()
+                self.__logger.debug('Got json %s', response)
+                return response
+        finally:
+            metrics.TELEGRAM.observe(time.monotonic() - start, path, outcome)
+
+    async def get_updates(self, offset=None):
+        data = dict(allowed_updates=json.dumps(config.ALLOWED_UPDATES))
+
+        if offset is None:
+            offset = self.updates.offset
+
+        if offset is not None:
+            data['offset'] = offset
 
-    async def get_updates(self):
-        data = None
+        timeout = 30
 
-        if self.__processed_status:
-            data = dict(offset=max(self.__processed_status) + 1)
+        if config.LONG_POLLING_TIMEOUT:
+            data['timeout'] = config.LONG_POLLING_TIMEOUT
+
+            # the client has to wait longer than telegram holds the request
+            timeout = config.LONG_POLLING_TIMEOUT + 10
+
+        response = await self.__request('getUpdates', data=data, timeout=timeout)
+
+        # a 409 when a webhook is set or another poller is running, 401, 429...
+        if not response.get('ok'):
+            raise TelegramApiError(response.get('error_code'),
+                                   'Telegram answered {} to getUpdates'.format(response.get('description')),
+                                   Outbox.retry_after(response))
 
-        response = await self.__request('getUpdates', data=data)
         return response.get('result', [])
 
-    async def send_message(self, chat_id, message, in_reply_to=None, preview=False, markdown=False):
+    async def __post(self, method, data):
+        return await self.__request(method, 'post', data=data)
+
+    async def __send(self, method, data, priority):
+        if self.outbox:
+            return await self.outbox.send(data['chat_id'], method, data, priority)
+
+        return await self.__post(method, data)
+
+    def __message_data(self, chat_id, message, in_reply_to=None, preview=False, markdown=False):
         data = dict(chat_id=chat_id, text=message)
 
         if in_reply_to:
@@ -69,19 +187,34 @@ class TelegramBot:
         if markdown:
             data['parse_mode'] = 'Markdown'
 
-        return await self.__request('sendMessage', 'post', data=data)
+        return data
 
-    async def send_document(self, chat_id, file_id_or_url, in_reply_to=None, preview=False):
+    async def send_message(self, chat_id, message, in_reply_to=None, preview=False, markdown=False,
+                           priority=NORMAL):
+        data = self.__message_data(chat_id, message, in_reply_to, preview, markdown)
+        return await self.__send('sendMessage', data, priority)
+
+    async def answer(self, message, text, in_reply_to=None, preview=False, markdown=False):
+        """ Sends text to the chat the message came from. The first answer to a
+        webhook update may go back in the webhook response """
+        data = self.__message_data(message['chat']['id'], text, in_reply_to, preview, markdown)
+        reply = message.get('webhook_reply')
+
+        if reply and reply.offer('sendMessage', data):
+            return dict(ok=True, result=None)
+
+        return await self.__send('sendMessage', data, NORMAL)
+
+    async def send_document(self, chat_id, file_id_or_url, in_reply_to=None, preview=False, priority=LOW):
         data = dict(chat_id=chat_id, document=file_id_or_url)
 
         if in_reply_to:
             data['reply_to_message_id'] = int(in_reply_to)
 
-        headers = {}
-
-        return await self.__request('sendDocument', 'post', data=data, headers=headers)
+        return await self.__send_media('sendDocument', 'document', data, priority)
 
-    async def send_photo(self, chat_id, file_id_or_url, caption=None, in_reply_to=None, preview=False):
+    async def send_photo(self, chat_id, file_id_or_url, caption=None, in_reply_to=None, preview=False,
+                         priority=LOW):
         data = dict(chat_id=chat_id, photo=file_id_or_url)
 
         if in_reply_to:
@@ -90,7 +223,53 @@ class TelegramBot:
         if caption:
             data['caption'] = caption
 
-        return await self.__request('sendPhoto', 'post', data=data, headers={})
+        return await self.__send_media('sendPhoto', 'photo', data, priority)
+
+    @staticmethod
+    def __sent_file_id(field, result):
+        if field == 'photo':
+            # the biggest size comes last
+            return result['photo'][-1]['file_id']
+
+        # gifs sent as documents come back as animations
+        media = result.get('document') or result.get('animation')
+        return media['file_id'] if media else None
+
+    async def __send_media(self, method, field, data, priority):
+        """ Sends urls we sent before by their file_id, and remembers the
+        file_id of the ones we didn't """
+        url = data[field]
+
+        if not self.media_cache or not url.startswith(('http://', 'https://')):
+            return await self.__send(method, data, priority)
+
+        file_id = await self.media_cache.get(url)
+
+        if file_id:
+            response = await self.__send(method, dict(data, **{field: file_id}), priority)
+
+            if response.get('ok') or response.get('error_code') != 400:
+                return response
+
+            self.__logger.warning('Telegram rejected the file_id of %s: %s', url, response.get('description'))
+            await self.media_cache.forget(url)
+
+        response = await self.__send(method, data, priority)
+
+        if response.get('ok'):
+            try:
+                file_id = self.__sent_file_id(field, response['result'])
+            except (KeyError, IndexError, TypeError):
+                file_id = None
+
+            if file_id:
+                await self.media_cache.put(url, file_id)
+
+        return response
+
+    async def answer_inline_query(self, inline_query_id, results, cache_time=30):
+        data = dict(inline_query_id=inline_query_id, results=json.dumps(results), cache_time=cache_time)
+        return await self.__request('answerInlineQuery', 'post', data=data)
 
     async def me(self):
         return await self.__request('getMe')
@@ -116,24 +295,53 @@ class TelegramBot:
 
         return await self.__request('getFile', data=data)
 
-    async def download_file(self, file_path):
+    async def download_file(self, file_path, fd=None, digest=None, chunk_size=64 * 1024):
+        """ Streams the file into fd, an in memory buffer by default, feeding
+        every chunk to digest (a hashlib object) along the way """
         url = "{}/{}".format(self._file_url, file_path)
+        fd = fd if fd is not None else io.BytesIO()
 
         async with self.client.get(url) as response:
-            return io.BytesIO(await response.read())
+            while True:
+                chunk = await response.content.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                fd.write(chunk)
 
-    async def get_processed_ids(self):
-        updates = await self.redis.smembers('bot:updates')
-        return set(map(int, updates))
+                if digest is not None:
+                    digest.update(chunk)
+
+        fd.seek(0)
+        return fd
 
     def __extension_manager_callback(self, ext, *args, **kwargs):
         self.__logger.info('Loading command %s', ext.name)
         return ext.name, ext.obj
 
     async def setup(self):
+        self.monitor = LoopMonitor(config.LOOP_LAG_INTERVAL, config.LOOP_LAG_THRESHOLD)
+        self.monitor.start()
+
         self.redis = await aioredis.create_redis((config.REDIS_HOST, config.REDIS_PORT,), encoding='utf8')
-        self.__processed_status = await self.get_processed_ids()
-        self.client = aiohttp.ClientSession()
+
+        if config.METRICS:
+            self.redis = metrics.InstrumentedRedis(self.redis)
+            metrics.QUEUES.watch(lambda: {(k,): v for k, v in self.queue_stats().items()})
+            metrics.CACHES.watch(self.cache_stats)
+
+        self.updates = UpdateStore(self.redis, config.UPDATES_WINDOW)
+        await self.updates.load()
+        self.client = self.create_client()
+        self.http_cache = ResponseCache(self.redis if config.HTTP_CACHE_REDIS else None, config.HTTP_CACHE_SIZE)
+        self.media_cache = MediaCache(self.redis, config.MEDIA_CACHE_SIZE, config.MEDIA_CACHE_SHARED_SIZE)
+        await self.media_cache.load()
+
+        if config.RATE_LIMIT:
+            self.outbox = Outbox(self.__post, config.GLOBAL_RATE, config.CHAT_RATE, config.CHAT_BURST,
+                                 config.OUTBOX_SIZE, config.SEND_RETRIES)
+            self.outbox.start()
 
         extension_manager = extension.ExtensionManager(namespace='ofensivaria.bot.commands',
                                                        invoke_on_load=True,
@@ -141,47 +349,189 @@ class TelegramBot:
 
         commands = extension_manager.map(self.__extension_manager_callback)
         self.commands = [obj for name, obj in sorted(commands)]
+        self.dispatcher = CommandDispatcher(self, self.commands)
 
         prepare_tasks = [c.prepare() for c in self.commands]
         await asyncio.gather(*prepare_tasks)
 
+        self.scheduler = Scheduler(self.redis)
+
+        for command in self.commands:
+            self.scheduler.discover(command)
+
+        self.scheduler.start()
+
+        if config.RECORD_PATH:
+            self.recorder = TrafficRecorder(config.RECORD_PATH, config.RECORD_KEY, config.RECORD_SCRAMBLE,
+                                            config.RECORD_SAMPLE)
+
+        if config.WORKERS > 0:
+            self.workers = ChatWorkerPool(self.handle_update, config.WORKERS, config.MAX_PENDING_UPDATES)
+
         self.__setup = True
 
+    def create_client(self):
+        """ The http session used for telegram and everything commands request """
+        return aiohttp.ClientSession()
+
+    def backoff(self, failures):
+        # exponential backoff with full jitter
+        delay = min(config.MAX_BACKOFF, self._repolling * 2 ** (failures - 1))
+        return random.uniform(0, delay)
+
     async def polling(self):
         if not self.__setup:
             raise Exception("Cannot start polling without setting up first")
 
-        while True:
-            updates = await self.get_updates()
+        offset = None
+        failures = 0
 
-            for update in updates:
+        while True:
+            try:
+                updates = await self.get_updates(offset)
+                failures = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, TelegramApiError) as e:
+                failures += 1
+                delay = max(self.backoff(failures), getattr(e, 'retry_after', None) or 0)
+                self.__logger.warning("Could not get updates (%r). Retrying in %.2fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            for update in await self.mark_processed(updates):
                 self.__logger.info("Processing %s", update)
-                await self.process_update(update)
+
+                if self.workers:
+                    await self.workers.submit(update)
+                else:
+                    await self.handle_update(update)
+
+            if updates:
+                offset = max(update['update_id'] for update in updates) + 1
+
+            if self.workers:
+                self.__logger.info("Workers: %s", self.queue_stats())
+
+            # telegram already waited for us when long polling, and there
+            # might be more updates waiting when the batch wasn't empty
+            if updates or config.LONG_POLLING_TIMEOUT:
+                continue
 
             self.__logger.info("Sleeping for %s", self._repolling)
             await asyncio.sleep(self._repolling)
 
+    async def mark_processed(self, updates):
+        """ Marks a whole batch as processed in one redis round trip, before
+        any command runs. Returns the updates that still need handling """
+        updates = [u for u in updates if not self.updates.seen(u['update_id'])]
+        new = await self.updates.mark_many([u['update_id'] for u in updates])
+        return [u for u in updates if u['update_id'] in new]
+
     async def process_update(self, update):
         id = update['update_id']
-        if id in self.__processed_status:
+        if self.updates.seen(id) or not await self.updates.mark(id):
+            WebhookReply.release(update)
             return
 
-        await self.redis.sadd('bot:updates', id)
-        self.__processed_status.add(id)
+        await self.handle_update(update)
 
-        message = update.get('message')
+    async def enqueue_update(self, update):
+        """ Hands the update to the worker pool. Returns False when the pool
+        is full, so the caller can ask telegram to deliver it again later """
+        if self.workers.is_full:
+            self.__logger.warning("Worker queue is full: %s", self.queue_stats())
+            return False
 
-        if message:
-            for command in self.commands:
+        updates = await self.mark_processed([update])
+
+        if not updates:
+            WebhookReply.release(update)
+
+        # other deliveries may have filled the pool while we were marking
+        for update in updates:
+            if not self.workers.try_submit(update):
+                self.__logger.warning("Worker queue is full: %s", self.queue_stats())
+                await self.updates.unmark(update['update_id'])
+                WebhookReply.release(update)
+                return False
+
+        return True
+
+    async def handle_update(self, update):
+        # every update has its id and one other field saying what it is
+        metrics.UPDATES.inc(next((k for k in update if k != 'update_id'), 'unknown'))
+        entry = self.recorder.capture(update) if self.recorder else None
+        answers = 0
+
+        try:
+            inline_query = update.get('inline_query')
+
+            if inline_query:
+                results = await self.dispatcher.dispatch_inline(inline_query)
+                await self.answer_inline_query(inline_query['id'], results)
+                answers = 1
+
+            message = update.get('message')
+
+            if message:
                 try:
-                    response = await command.process(self, message)
+                    answers = int(await self.dispatcher.dispatch(message))
+                finally:
+                    # writes commands deferred with Command.defer
+                    pipeline = message.pop('pipeline', None)
+
+                    if pipeline:
+                        await pipeline.execute()
+
+                    WebhookReply.release(update)
+        finally:
+            if entry:
+                self.recorder.write(entry, answers)
+
+    def cache_stats(self):
+        stats = {}
+
+        for name, cache in (('http', self.http_cache), ('media', self.media_cache)):
+            if cache:
+                stats[(name, 'hit')] = cache.hits
+                stats[(name, 'miss')] = cache.misses
 
-                    if response:
-                        break
-                except Exception as e:
-                    self.__logger.exception(e)
+        if self.http_cache:
+            stats[('http', 'stale')] = self.http_cache.stale_hits
+
+        return stats
+
+    def queue_stats(self):
+        if not self.workers:
+            stats = dict(queued=0, in_flight=0, chats=0)
+        else:
+            stats = self.workers.stats()
+
+        if self.outbox:
+            stats.update(outbox_queued=self.outbox.queue_depth, outbox_in_flight=self.outbox.in_flight)
+
+        return stats
 
     async def cleanup(self):
+        if self.profiler.running:
+            self.profiler.stop()
+
+        if self.monitor:
+            await self.monitor.close()
+
+        if self.scheduler:
+            await self.scheduler.close()
+
+        if self.workers:
+            await self.workers.close()
+
+        if self.recorder:
+            self.recorder.close()
+
+        await asyncio.gather(*[c.cleanup() for c in self.commands], return_exceptions=True)
+
+        if self.outbox:
+            await self.outbox.close()
+
         self.redis.close()
         await self.redis.wait_closed()
         await self.client.close()
@@ -0,0 +1,237 @@
+import time
+import json
+import asyncio
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+from ofensivaria import config
+
+
+class CachedResponse:
+    """ What we keep of an aiohttp response, enough for what commands read from it """
+
+    def __init__(self, status, url, headers=None):
+        self.status = status
+        self.url = url
+        self.headers = headers or {}
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status, str(response.url), dict(response.headers))
+
+
+class ResponseCache:
+    """ Caches http responses for Command.http_get.
+
+    Entries are fresh for their ttl and after that, for as long again, stale:
+    a stale entry is still answered while it's fetched again in the background.
+    The newest `size` entries are kept in memory and, when there's redis, every
+    process shares them there too. Concurrent requests for the same key wait
+    for a single fetch. """
+
+    KEY = 'bot:http:%s'
+
+    def __init__(self, redis=None, size=512):
+        self._redis = redis
+        self._size = size
+        self._entries = OrderedDict()
+        self._fetching = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._logger = logging.getLogger('cache')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @staticmethod
+    def key(url, params=None, *extra):
+        params = sorted((params or {}).items())
+        return json.dumps([url, params] + list(extra))
+
+    def __store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    async def __load(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None and self._redis:
+            digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+            data = await self._redis.get(self.KEY % digest)
+
+            if data:
+                fresh, stale, status, url, content = json.loads(data)
+                entry = (fresh, stale, (CachedResponse(status, url), content))
+                self.__store(key, entry)
+
+        return entry
+
+    async def get(self, key, fetch, ttl, cacheable=None):
+        """ fetch is a coroutine function returning (response, content). A ttl of 0
+        doesn't keep anything, but still joins concurrent requests. Neither does
+        cacheable(content) returning False """
+        entry = await self.__load(key) if ttl else None
+        now = time.time()
+
+        if entry:
+            fresh, stale, value = entry
+
+            if now < fresh:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+
+            if now < stale:
+                self.stale_hits += 1
+                self.__fetch(key, fetch, ttl, cacheable)
+                return value
+
+        self.misses += 1
+        return await asyncio.shield(self.__fetch(key, fetch, ttl, cacheable))
+
+    def __fetch(self, key, fetch, ttl, cacheable):
+        future = self._fetching.get(key)
+
+        if future is None:
+            future = self._fetching[key] = asyncio.ensure_future(self.__refresh(key, fetch, ttl, cacheable))
+            future.add_done_callback(lambda f: self.__fetched(key, f))
+
+        return future
+
+    def __fetched(self, key, future):
+        del self._fetching[key]
+
+        # nobody may be waiting for a background refresh
+        if not future.cancelled() and future.exception():
+            self._logger.warning('Could not fetch: %r', future.exception())
+
+    async def __refresh(self, key, fetch, ttl, cacheable):
+        response, content = await fetch()
+
+        if not ttl or response.status != 200:
+            return response, content
+
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+
+        if cacheable and not cacheable(content):
+            # or a stale entry would keep being answered
+            self._entries.pop(key, None)
+
+            if self._redis:
+                await self._redis.delete(self.KEY % digest)
+
+            return response, content
+
+        now = time.time()
+        response = CachedResponse.from_response(response)
+        entry = (now + ttl, now + 2 * ttl, (response, content))
+        self.__store(key, entry)
+
+        if self._redis:
+            data = json.dumps([entry[0], entry[1], response.status, response.url, content])
+            await self._redis.setex(self.KEY % digest, int(2 * ttl), data)
+
+        return entry[2]
+
+
+class MediaCache:
+    """ Remembers the file_id telegram gave to the photos and documents we sent
+    by url, so sending them again doesn't make telegram fetch them again.
+
+    The newest `size` of them are kept in memory and the `shared_size` used
+    last in redis, where a sorted set keeps when each was last used. """
+
+    KEY = 'bot:media'
+    USED_KEY = 'bot:media:used'
+
+    def __init__(self, redis, size=1024, shared_size=20000):
+        self._redis = redis
+        self._size = size
+        self._shared_size = shared_size
+        self._entries = OrderedDict()
+        self._touching = set()
+        self.hits = 0
+        self.misses = 0
+        self._logger = logging.getLogger('cache')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    async def load(self):
+        """ Tracks urls the hash has but the sorted set lost, as the least
+        recently used, so they can be evicted too """
+        if await self._redis.exists(self.USED_KEY):
+            return
+
+        urls = await self._redis.hkeys(self.KEY)
+
+        if urls:
+            await self._redis.zadd(self.USED_KEY, *[value for url in urls for value in (0, url)])
+
+    def __store(self, url, file_id):
+        self._entries[url] = file_id
+        self._entries.move_to_end(url)
+
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    async def get(self, url):
+        file_id = self._entries.get(url)
+
+        if file_id is None:
+            file_id = await self._redis.hget(self.KEY, url)
+
+            if file_id:
+                self.__store(url, file_id)
+                self.__touch(url)
+
+        if file_id:
+            self.hits += 1
+            self._entries.move_to_end(url)
+        else:
+            self.misses += 1
+
+        return file_id
+
+    def __touch(self, url):
+        # nobody has to wait for it
+        touch = asyncio.ensure_future(self._redis.zadd(self.USED_KEY, time.time(), url))
+        touch.add_done_callback(self.__touched)
+        self._touching.add(touch)
+
+    def __touched(self, future):
+        self._touching.discard(future)
+
+        if not future.cancelled() and future.exception():
+            self._logger.warning('Could not mark a file as used: %r', future.exception())
+
+    async def put(self, url, file_id):
+        self.__store(url, file_id)
+
+        transaction = self._redis.multi_exec()
+        transaction.hset(self.KEY, url, file_id)
+        transaction.zadd(self.USED_KEY, time.time(), url)
+        transaction.zcard(self.USED_KEY)
+        *_, shared = await transaction.execute()
+
+        if shared > self._shared_size:
+            await self.__evict(shared - self._shared_size)
+
+    async def __evict(self, count):
+        urls = await self._redis.zrange(self.USED_KEY, 0, count - 1)
+
+        if urls:
+            transaction = self._redis.multi_exec()
+            transaction.hdel(self.KEY, *urls)
+            transaction.zrem(self.USED_KEY, *urls)
+            await transaction.execute()
+
+    async def forget(self, url):
+        self._entries.pop(url, None)
+
+        transaction = self._redis.multi_exec()
+        transaction.hdel(self.KEY, url)
+        transaction.zrem(self.USED_KEY, url)
+        await transaction.execute()
@@ -1,8 +1,14 @@
 import asyncio
-import aiofiles
-import markovify
+import aiohttp
+import aioredis
 
+import io
+import os
 import re
+import hashlib
+import tempfile
+import urllib.parse
+import time
 import random
 import logging
 
@@ -10,12 +16,14 @@ import abc
 import six
 import pytz
 
+from collections import deque
 from datetime import datetime, timedelta
 
 from decorator import decorator
-from ofensivaria import config
+from ofensivaria import config, markov, metrics
+from ofensivaria.scheduler import job
 
-from itertools import chain
+from itertools import count
 
 
 class ValidationException(Exception):
@@ -64,6 +72,18 @@ async def markdown(f, *args, **kwargs):
     return r
 
 
+def normalize_text(message):
+    try:
+        text = message['text'].encode("utf-8").decode("utf-8")
+        text = text.replace(u'\xa0', ' ')
+        message['text'] = text
+    except KeyError:
+        message['text'] = ''
+        text = ''
+
+    return text
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Command:
 
@@ -80,6 +100,10 @@ class Command:
 
     REQUIRED_PARAMS = False
 
+    # {url prefix: seconds} for how long http_get can reuse a response. 0 doesn't
+    # keep responses, but still joins concurrent requests for the same url
+    CACHE_TTL = {}
+
     def __init__(self, bot, redis, http_client):
         self._bot = bot
         self._redis = redis
@@ -103,6 +127,39 @@ class Command:
     async def prepare(self):
         return
 
+    async def cleanup(self):
+        return
+
+    def observe(self, message):
+        """ Called with every message the bot gets, before any command answers it.
+        Has to be cheap, anything heavy should be done in the background """
+        return
+
+    async def inline(self, query):
+        """ Commands that answer inline queries return a list of results here """
+        return None
+
+    def defer(self, message):
+        """ Returns a redis pipeline that is executed once the update was handled,
+        for writes nobody has to wait for """
+        if 'pipeline' not in message:
+            message['pipeline'] = self._redis.pipeline()
+
+        return message['pipeline']
+
+    @property
+    def slash_names(self):
+        if not self.SLASH_COMMAND:
+            return []
+
+        return [c.lower() for c in self._commands.keys()]
+
+    def prefilter(self, text, message):
+        """ Commands that override can_respond to answer messages that are not
+        slash commands should also override this with a cheap check, so the
+        dispatcher only tries them when they have a chance of answering """
+        return True
+
     def __validate_slash_command(self, text, message):
 
         result = self._slash_re.findall(text)
@@ -154,23 +211,59 @@ class Command:
 
         return False
 
+    def cache_ttl(self, url):
+        for prefix, ttl in self.CACHE_TTL.items():
+            if url.startswith(prefix):
+                return ttl
+
+        return None
+
+    def cacheable(self, url, content):
+        """ If a 200 response to an url in CACHE_TTL should be kept """
+        return True
+
     async def http_get(self, url, params=None, **kwargs):
+        ttl = self.cache_ttl(url)
+        cache = getattr(self._bot, 'http_cache', None)
+
+        if ttl is None or cache is None:
+            return await self.__http_get(url, params, **kwargs)
+
+        key = cache.key(url, params, kwargs.get('as_text', False))
+        return await cache.get(key, lambda: self.__http_get(url, params, **kwargs), ttl,
+                               lambda content: self.cacheable(url, content))
+
+    async def __http_get(self, url, params=None, **kwargs):
         kwargs.update({'timeout': 30, 'params': params})
 
         as_text = kwargs.pop('as_text', False)
-        async with self._http_client.get(url, **kwargs) as response:
-            if as_text:
-                content = await response.text()
-            else:
-                content = await response.json()
-            return response, content
+        start = time.monotonic()
+        outcome = 'error'
+
+        try:
+            async with self._http_client.get(url, **kwargs) as response:
+                outcome = str(response.status)
+
+                if as_text:
+                    content = await response.text()
+                else:
+                    content = await response.json()
+                return response, content
+        finally:
+            metrics.HTTP.observe(time.monotonic() - start, urllib.parse.urlsplit(url).hostname, 'get', outcome)
 
     async def http_post(self, url, data=None, **kwargs):
         kwargs.update({'timeout': 30, 'data': data})
+        start = time.monotonic()
+        outcome = 'error'
 
-        async with self._http_client.post(url, **kwargs) as response:
-            json = await response.json()
-            return response, json
+        try:
+            async with self._http_client.post(url, **kwargs) as response:
+                outcome = str(response.status)
+                json = await response.json()
+                return response, json
+        finally:
+            metrics.HTTP.observe(time.monotonic() - start, urllib.parse.urlsplit(url).hostname, 'post', outcome)
 
     async def __send_message(self, command_response, message):
 
@@ -197,28 +290,33 @@ class Command:
         reply_id = message.get('message_id', None) if needs_reply else None
 
         if answer:
-            await self._bot.send_message(message['chat']['id'], answer, reply_id, needs_preview, markdown)
+            await self._bot.answer(message, answer, reply_id, needs_preview, markdown)
 
     async def process(self, bot, message):
-        try:
-            text = message['text'].encode("utf-8").decode("utf-8")
-            text = text.replace(u'\xa0', ' ')
-            message['text'] = text
-        except KeyError:
-            message['text'] = ''
-            text = ''
+        text = normalize_text(message)
 
         try:
-            if self.can_respond(text, message):
-                response = await self.respond(text, message)
-                await self.__send_message(response, message)
-                return bool(response)
-            else:
+            if not self.can_respond(text, message):
                 return False
         except ValidationException as e:
             await self.__send_message(dict(answer=e.message), message)
             return True
 
+        start = time.monotonic()
+        outcome = 'error'
+
+        try:
+            response = await self.respond(text, message)
+            outcome = 'answered' if response else 'empty'
+            await self.__send_message(response, message)
+            return bool(response)
+        except ValidationException as e:
+            outcome = 'invalid'
+            await self.__send_message(dict(answer=e.message), message)
+            return True
+        finally:
+            metrics.COMMANDS.observe(time.monotonic() - start, type(self).__name__, outcome)
+
 
 class Ping(Command):
     """ Simple ping command to make sure the bot itself works """
@@ -279,6 +377,11 @@ class ArchiveUrl(Command):
     """ Tries to archive an url and returns the archive to the chat """
 
     SLASH_COMMAND = '/archive [url]'
+    CACHE_TTL = {'http://archive.org/wayback/available': 3600}
+
+    def cacheable(self, url, content):
+        # or it keeps saying a page isn't archived after someone archived it
+        return bool(content.get('archived_snapshots'))
 
     async def respond(self, text, message):
         url = message['args']['url']
@@ -333,18 +436,124 @@ class MessageToGif(Command):
     will send the gif to the chat. Supports more than one gif per name."""
 
     SLASH_COMMAND = ('/teach [name] [url]', '/forget [name]',
-                     '/randomgif', '/gifs')
+                     '/randomgif', '/gifs [query]')
 
     def can_respond(self, text, message):
         return (text.endswith('.gif') and ' ' not in text) or super(MessageToGif, self).can_respond(text, message)
 
+    def prefilter(self, text, message):
+        return text.endswith('.gif')
+
+    GIFS_KEY = 'bot:gifs'
+    EVENTS_CHANNEL = 'bot:gifs:events'
+
+    # every name with score 0, so the sorted set is ordered by name
+    LEX_KEY = 'bot:gifs:lex'
+    PAGE_SIZE = 50
+    INLINE_RESULTS = 20
+
+    # picks one of the urls of a gif in a single round trip
+    RANDOM_SCRIPT = """
+        local size = redis.call('llen', KEYS[1])
+
+        if size == 0 then
+            return false
+        end
+
+        return redis.call('lindex', KEYS[1], tonumber(ARGV[1]) % size)
+    """
+
+    async def prepare(self):
+        await self.load_names()
+
+        if self._names and not await self._redis.exists(self.LEX_KEY):
+            await self._redis.zadd(self.LEX_KEY, *[v for name in self._names for v in (0, name)])
+
+        # every process keeps its own copy of the names, /teach and /forget
+        # tell the others about changes
+        channel = await self.__subscribe()
+        self._listening = asyncio.ensure_future(self.__listen(channel))
+
+    async def cleanup(self):
+        self._listening.cancel()
+        await self.__unsubscribe()
+
+    async def __subscribe(self):
+        self._subscriber = await aioredis.create_redis((config.REDIS_HOST, config.REDIS_PORT,), encoding='utf8')
+        channel, = await self._subscriber.subscribe(self.EVENTS_CHANNEL)
+        return channel
+
+    async def __unsubscribe(self):
+        if self._subscriber:
+            self._subscriber.close()
+            await self._subscriber.wait_closed()
+            self._subscriber = None
+
+    @job(interval=600, jitter=60, lock=False, warm_up=False)
+    async def load_names(self):
+        """ Loads every gif name, also catching up with anything we missed """
+        names = await self._redis.smembers(self.GIFS_KEY)
+        self._names = list(names)
+        self._positions = {name: i for i, name in enumerate(self._names)}
+
+    async def __listen(self, channel):
+        delay = 1
+
+        while True:
+            try:
+                if channel is None:
+                    channel = await self.__subscribe()
+
+                    # whatever was taught or forgotten while we weren't listening
+                    await self.load_names()
+                    self._logger.info('Subscribed to %s again', self.EVENTS_CHANNEL)
+                    delay = 1
+
+                while await channel.wait_message():
+                    event = await channel.get(encoding='utf8')
+                    action, _, name = event.partition(':')
+
+                    if action == 'teach':
+                        self.__add_name(name)
+                    elif action == 'forget':
+                        self.__remove_name(name)
+
+                self._logger.warning('Lost the subscription to %s, subscribing again in %ss',
+                                     self.EVENTS_CHANNEL, delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._logger.exception('Could not listen to %s, trying again in %ss', self.EVENTS_CHANNEL, delay)
+
+            channel = None
+            await self.__unsubscribe()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def __add_name(self, name):
+        if name not in self._positions:
+            self._positions[name] = len(self._names)
+            self._names.append(name)
+
+    def __remove_name(self, name):
+        position = self._positions.pop(name, None)
+
+        if position is None:
+            return
+
+        last = self._names.pop()
+
+        if position < len(self._names):
+            self._names[position] = last
+            self._positions[last] = position
+
     async def get_gif(self, name):
-        try:
-            key = 'bot:gifs:%s' % name
-            return random.choice(await self._redis.lrange(key, 0, -1))
-        except IndexError:
+        if name not in self._positions:
             return
 
+        key = '%s:%s' % (self.GIFS_KEY, name)
+        return await self._redis.eval(self.RANDOM_SCRIPT, keys=[key], args=[random.getrandbits(31)])
+
     async def command_teach(self, url, name):
         try:
             if not name.endswith('.gif'):
@@ -354,26 +563,87 @@ class MessageToGif(Command):
                 return "gif is not a link"
 
             else:
-                await self._redis.sadd('bot:gifs', name)
-                await self._redis.lpush('bot:gifs:%s' % name, url)
+                transaction = self._redis.multi_exec()
+                transaction.sadd(self.GIFS_KEY, name)
+                transaction.lpush('%s:%s' % (self.GIFS_KEY, name), url)
+                transaction.zadd(self.LEX_KEY, 0, name)
+                transaction.publish(self.EVENTS_CHANNEL, 'teach:%s' % name)
+                await transaction.execute()
+
+                self.__add_name(name)
                 return "now i know about %s" % name
 
         except ValueError:
             return "/teach <name.gif> <url> is the right format"
 
     async def command_forget(self, name):
-        await self._redis.delete('bot:gifs:%s' % name)
-        await self._redis.srem('bot:gifs', name)
-
+        transaction = self._redis.multi_exec()
+        transaction.delete('%s:%s' % (self.GIFS_KEY, name))
+        transaction.srem(self.GIFS_KEY, name)
+        transaction.zrem(self.LEX_KEY, name)
+        transaction.publish(self.EVENTS_CHANNEL, 'forget:%s' % name)
+        await transaction.execute()
+
+        self.__remove_name(name)
         return "forgot %s" % name
 
     async def command_randomgif(self):
-        gif_name = (await self._redis.srandmember('bot:gifs'))
-        return await self.get_gif(gif_name)
+        if not self._names:
+            return
+
+        return await self.get_gif(random.choice(self._names))
+
+    async def search(self, prefix='', offset=0, count=PAGE_SIZE):
+        """ Names starting with prefix, in order """
+        prefix = prefix.encode('utf8')
+
+        if prefix:
+            # no utf-8 byte is \xff, so this is after every name with the prefix
+            return await self._redis.zrangebylex(self.LEX_KEY, prefix, prefix + b'\xff', offset=offset, count=count)
+
+        return await self._redis.zrangebylex(self.LEX_KEY, offset=offset, count=count)
+
+    async def command_gifs(self, query=None):
+        """ /gifs [page] or /gifs <prefix> [page] """
+        words = (query or '').split()
+        page = 1
+
+        if words and words[-1].isdigit():
+            page = max(1, int(words.pop()))
+
+        prefix = words[0] if words else ''
+        names = await self.search(prefix, (page - 1) * self.PAGE_SIZE, self.PAGE_SIZE + 1)
+
+        if not names:
+            return "no gifs here"
+
+        answer = ', '.join(names[:self.PAGE_SIZE])
+
+        if len(names) > self.PAGE_SIZE:
+            answer += '\n\n/gifs %s%s for more' % (prefix + ' ' if prefix else '', page + 1)
+
+        return answer
 
-    async def command_gifs(self):
-        gifs = sorted(await self._redis.smembers('bot:gifs'))
-        return ', '.join(sorted(gifs))
+    async def inline(self, query):
+        names = await self.search(query['query'].strip(), 0, self.INLINE_RESULTS)
+
+        if not names:
+            return None
+
+        pipeline = self._redis.pipeline()
+        urls = [pipeline.lindex('%s:%s' % (self.GIFS_KEY, name), 0) for name in names]
+        await pipeline.execute()
+
+        results = []
+
+        for name, url in zip(names, urls):
+            url = await url
+
+            if url:
+                results.append(dict(type='article', id=name[:64], title=name,
+                                    input_message_content=dict(message_text=url)))
+
+        return results
 
     @preview
     async def respond(self, text, message):
@@ -404,20 +674,52 @@ class ConvertCurrency(Command):
              'SYS', 'TRX', 'UBQ', 'USDT', 'VEN', 'VERI', 'VTC', 'WAVES', 'WTC', 'XAS',
              'XEM', 'XLM', 'XMR', 'XRP', 'XVG', 'XZC', 'ZEC', 'ZEN', 'ZRX', 'ZSC']
 
-    async def get_coin_value(self, symbol):
-        coins = await self._redis.hgetall('bot:coins')
+    PRICES_KEY = 'bot:coins'
+    UPDATED_KEY = 'bot:coins:updated'
+
+    # prices are refreshed in the background this often, so /convert never
+    # waits for coinmarketcap
+    REFRESH_AFTER = 600
+
+    async def prepare(self):
+        self._prices = {}
+        self._updated = 0
+
+    @property
+    def cache_age(self):
+        return time.time() - self._updated if self._updated else None
+
+    @job(interval=REFRESH_AFTER, jitter=30, timeout=60)
+    async def fetch_prices(self):
+        _, coins = await self.http_get("https://api.coinmarketcap.com/v1/ticker/", params={'convert': 'BRL'})
+        coins = {t['symbol']: float(t['price_brl']) for t in coins}
+
+        transaction = self._redis.multi_exec()
+        transaction.hmset_dict(self.PRICES_KEY, coins)
+        transaction.persist(self.PRICES_KEY)
+        transaction.set(self.UPDATED_KEY, time.time())
+        await transaction.execute()
 
-        if not coins:
-            _, coins = await self.http_get("https://api.coinmarketcap.com/v1/ticker/", params={'convert': 'BRL'})
-            coins = {t['symbol']: float(t['price_brl']) for t in coins}
+        await self.load_prices()
 
-            await self._redis.hmset_dict('bot:coins', coins)
-            await self._redis.expire('bot:coins', 720)
+    @job(interval=60, jitter=10, lock=False)
+    async def load_prices(self):
+        """ Every process keeps a copy of the prices some process fetched """
+        updated = await self._redis.get(self.UPDATED_KEY)
 
+        if updated and float(updated) > self._updated:
+            prices = await self._redis.hgetall(self.PRICES_KEY)
+            self._prices = {symbol: float(value) for symbol, value in prices.items()}
+            self._updated = float(updated)
+
+    async def get_coin_value(self, symbol):
         try:
-            return float(coins[symbol])
+            return self._prices[symbol]
         except KeyError:
-            return None
+            pass
+
+        value = await self._redis.hget(self.PRICES_KEY, symbol)
+        return float(value) if value else None
 
     async def get_currency_value(self, symbol):
         _, json = await self.http_get('http://api.fixer.io/latest', params={'base': symbol, 'symbols': 'BRL'})
@@ -444,7 +746,12 @@ class ConvertCurrency(Command):
         if not currency_value:
             return "Could not get value for currency %s" % symbol
 
+        age = self.cache_age
+
         try:
+            if age and age > 2 * self.REFRESH_AFTER:
+                return "R$%.2f (prices from %d minutes ago)" % (float(value) * currency_value, age // 60)
+
             return "R$%.2f" % (float(value) * currency_value)
         except KeyError:
             return 'Could not get value for currency %s' % symbol
@@ -497,6 +804,7 @@ class ProgrammerExcuses(Command):
     References: http://programmingexcuses.com/ , https://github.com/yelinaung/pe-api"""
 
     SLASH_COMMAND = '/excuse'
+    CACHE_TTL = {'http://pe-api.herokuapp.com/': 0}
 
     async def respond(self, text, message):
         _, json = await self.http_get('http://pe-api.herokuapp.com/')
@@ -511,6 +819,14 @@ class Imgur(Command):
 
     SLASH_COMMAND = '/imgurid [client_id]'
 
+    # link by telegram file_id and by sha256 of the image, the same image
+    # forwarded again comes with a new file_id
+    LINKS_KEY = 'bot:imgur'
+    HASHES_KEY = 'bot:imgur:hashes'
+
+    async def prepare(self):
+        self._uploads = asyncio.Semaphore(config.IMGUR_UPLOADS)
+
     def can_respond(self, text, message):
         try:
             photo = message['photo']
@@ -520,6 +836,9 @@ class Imgur(Command):
         except KeyError:
             return super(Imgur, self).can_respond(text, message)
 
+    def prefilter(self, text, message):
+        return 'photo' in message
+
     async def respond(self, text, message):
         command = message.get('command', None)
 
@@ -542,7 +861,7 @@ class Imgur(Command):
         photo = message['photo'][-1]
         file_id = photo['file_id']
 
-        cached_image = await self._redis.hget('bot:imgur', file_id)
+        cached_image = await self._redis.hget(self.LINKS_KEY, file_id)
 
         if cached_image:
             return cached_image
@@ -552,21 +871,42 @@ class Imgur(Command):
         if not client_id:
             return 'Nobody set my client id for imgur'
 
-        file_obj = await self._bot.get_file(file_id)
-        file_path = file_obj['result']['file_path']
-        fd = await self._bot.download_file(file_path)
+        # only a few photos are held at once, and only small ones in memory.
+        # aiohttp only sends an io.IOBase as a file: SpooledTemporaryFile isn't
+        # one before python 3.11, NamedTemporaryFile's wrapper isn't one either
+        # and TemporaryFile has no name to send
+        small = photo.get('file_size', config.IMGUR_SPOOL_SIZE + 1) <= config.IMGUR_SPOOL_SIZE
+
+        async with self._uploads:
+            file_obj = await self._bot.get_file(file_id)
+            file_path = file_obj['result']['file_path']
+
+            with io.BytesIO() if small else tempfile.NamedTemporaryFile() as spool:
+                fd = getattr(spool, 'file', spool)
+                digest = hashlib.sha256()
+                await self._bot.download_file(file_path, fd, digest)
+                digest = digest.hexdigest()
+
+                link = await self._redis.hget(self.HASHES_KEY, digest)
 
-        data = {'image': fd}
-        headers = {'Authorization': 'Client-ID {}'.format(client_id)}
+                if link:
+                    self.defer(message).hset(self.LINKS_KEY, file_id, link)
+                    return link
 
-        response, json = await self.http_post('https://api.imgur.com/3/image', data=data, headers=headers)
+                data = aiohttp.FormData()
+                data.add_field('image', fd, filename='image', content_type='application/octet-stream')
+                headers = {'Authorization': 'Client-ID {}'.format(client_id)}
+
+                response, json = await self.http_post('https://api.imgur.com/3/image', data=data, headers=headers)
 
         try:
             if not json['success']:
                 raise ValueError
 
             link = json['data']['link']
-            await self._redis.hset('bot:imgur', file_id, link)
+            pipeline = self.defer(message)
+            pipeline.hset(self.LINKS_KEY, file_id, link)
+            pipeline.hset(self.HASHES_KEY, digest, link)
 
             return link
         except (KeyError, ValueError):
@@ -574,6 +914,39 @@ class Imgur(Command):
             return "Could not upload :("
 
 
+class Profile(Command):
+    """ Samples what the event loop is doing, for admins """
+
+    SLASH_COMMAND = '/profile [action]'
+
+    def can_respond(self, text, message):
+        if message.get('from', {}).get('id') not in config.ADMINS:
+            return False
+
+        return super(Profile, self).can_respond(text, message)
+
+    def prefilter(self, text, message):
+        # only ever answers /profile, which the dispatcher finds by name
+        return False
+
+    async def respond(self, text, message):
+        action = message['args'].get('action', 'status')
+        profiler = self._bot.profiler
+
+        if action == 'start':
+            if not profiler.start():
+                return 'already profiling'
+
+            return 'profiling. /profile stop when you are done'
+
+        if action == 'stop':
+            path = profiler.stop()
+            return f'wrote the stacks to {path}' if path else 'not profiling'
+
+        state = f'profiling for {time.time() - profiler.started:.0f}s' if profiler.running else 'not profiling'
+        return f'{state}\nloop: {self._bot.monitor.stats()}'
+
+
 class FlipTable(Command):
 
     SLASH_COMMAND = '/flip'
@@ -598,7 +971,7 @@ class RussianRouletteCommand(Command):
         username = message['from']['first_name']
 
         if random.randint(1, 6) == 3:
-            await self._redis.hincrby('russian', username, 1)
+            self.defer(message).hincrby('russian', username, 1)
             return "BANG! ~reloading"
         else:
             return "*click*"
@@ -661,48 +1034,196 @@ class YugiOhCard(Command):
         async with self._http_client.get(url) as response:
             return await response.json()
 
+    NO_IMAGE_KEY = 'cards:noimage'
+
+    # cards whose image we couldn't tell about, not tried again for a while
+    UNKNOWN_IMAGE_KEY = 'cards:unknownimage:%s'
+    UNKNOWN_IMAGE_TTL = 24 * 3600
+    IMPORT_DONE_KEY = 'cards:import:done'
+    IMPORT_PAGES_KEY = 'cards:import:pages'
+
+    # the wiki answers 500 cards per page. we ask for a few pages at a time
+    # and write the cards in batches
+    PAGE_SIZE = 500
+    IMPORT_CONCURRENCY = 3
+    IMPORT_BATCH = 100
+    IMPORT_RETRIES = 3
+
+    # how many cards with images we keep ready to send, how many cards we
+    # check for images at the same time and how many batches of cards a
+    # single /randomcard may check
+    READY_CARDS = 10
+    PROBES = 5
+    PROBE_ROUNDS = 3
+
+    async def prepare(self):
+        self._ready = deque()
+        self._probes = asyncio.Semaphore(self.PROBES)
+        self._filling = None
+
     async def _get_image(self, card_name):
+        """ Returns the image url of the card, False if it has none or None if
+        we couldn't tell """
         url = f'http://yugiohprices.com/api/card_image/{card_name}'
 
-        async with self._http_client.get(url) as response:
-            if response.status == 404:
-                return False
+        async with self._probes:
+            async with self._http_client.get(url, allow_redirects=False) as response:
+                if response.status == 404:
+                    return False
 
-            return response.history[0].headers['Location']
+                if 300 <= response.status < 400:
+                    return response.headers.get('Location')
 
-    async def command_downloadcards(self, *args, **kwargs):
-        number = await self._redis.scard('cards')
+                # the image itself, without a redirect
+                if 200 <= response.status < 300 and response.content_type.startswith('image/'):
+                    return url
+
+                return None
+
+    async def __probe(self, card_name):
+        image = await self._get_image(card_name)
+
+        if image is False:
+            # never pick it again
+            await self._redis.smove('cards', self.NO_IMAGE_KEY, card_name)
+        elif image is None:
+            await self._redis.setex(self.UNKNOWN_IMAGE_KEY % card_name, self.UNKNOWN_IMAGE_TTL, 1)
+
+        return image
+
+    async def fill(self):
+        """ Finds cards with images until there are READY_CARDS of them """
+        for _ in range(self.PROBE_ROUNDS):
+            missing = self.READY_CARDS - len(self._ready)
+
+            if missing <= 0:
+                return
+
+            names = list(set(await self._redis.srandmember('cards', missing)))
+
+            if not names:
+                return
+
+            pipeline = self._redis.pipeline()
+            cached = pipeline.hmget('card_cache', *names)
+            skipped = pipeline.mget(*[self.UNKNOWN_IMAGE_KEY % name for name in names])
+            await pipeline.execute()
+            cached, skipped = await cached, await skipped
+
+            self._ready.extend((name, file_id) for name, file_id in zip(names, cached) if file_id)
+
+            unknown = [name for name, file_id, skip in zip(names, cached, skipped) if not file_id and not skip]
+            images = await asyncio.gather(*[self.__probe(name) for name in unknown], return_exceptions=True)
+            self._ready.extend((name, image) for name, image in zip(unknown, images) if isinstance(image, str))
+
+    def __refill(self):
+        if len(self._ready) < self.READY_CARDS // 2 and (self._filling is None or self._filling.done()):
+            self._filling = asyncio.ensure_future(self.fill())
+
+    @job(interval=300, jitter=30, lock=False)
+    async def prefetch_cards(self):
+        await self.fill()
+
+    async def _get_page(self, offset):
+        for attempt in range(self.IMPORT_RETRIES):
+            try:
+                page = await self._get(self.URL + str(offset))
+                return list((page.get('results') or {}).keys())
+            except Exception:
+                if attempt == self.IMPORT_RETRIES - 1:
+                    raise
+
+                await asyncio.sleep(2 ** attempt)
+
+    async def __save_page(self, offset, cards):
+        transaction = self._redis.multi_exec()
+
+        for i in range(0, len(cards), self.IMPORT_BATCH):
+            transaction.sadd('cards', *cards[i:i + self.IMPORT_BATCH])
+
+        # the page only counts as imported together with its cards
+        transaction.hset(self.IMPORT_PAGES_KEY, offset, len(cards))
+        await transaction.execute()
+
+    async def import_cards(self):
+        """ Imports the catalog page by page, a few pages at a time, until the
+        first page that isn't full. Imported pages are checkpointed, so an
+        import that failed halfway continues from where it stopped """
+        imported = {int(k): int(v) for k, v in (await self._redis.hgetall(self.IMPORT_PAGES_KEY)).items()}
+        offsets = count(0, self.PAGE_SIZE)
+        last = None
+
+        async def worker():
+            nonlocal last
+
+            for offset in offsets:
+                if last is not None and offset > last:
+                    return
+
+                if offset in imported:
+                    size = imported[offset]
+                else:
+                    cards = await self._get_page(offset)
+                    await self.__save_page(offset, cards)
+                    size = len(cards)
+
+                if size < self.PAGE_SIZE:
+                    last = offset if last is None else min(last, offset)
+
+        results = await asyncio.gather(*[worker() for _ in range(self.IMPORT_CONCURRENCY)],
+                                       return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
-        if not number:
-            urls = [self.URL + str(offset) for offset in range(0, 6000, 500)]
-            tasks = [self._get(url) for url in urls]
-            results = await asyncio.gather(*tasks)
+        transaction = self._redis.multi_exec()
+        transaction.sdiffstore('cards', 'cards', self.NO_IMAGE_KEY)
+        transaction.set(self.IMPORT_DONE_KEY, 1)
+        transaction.delete(self.IMPORT_PAGES_KEY)
+        await transaction.execute()
 
-            cards = [c['results'].keys() for c in results]
-            cards = list(chain(*cards))
+    async def command_downloadcards(self, *args, **kwargs):
+        done = await self._redis.get(self.IMPORT_DONE_KEY)
+
+        # imported before we kept checkpoints
+        if not done and not await self._redis.exists(self.IMPORT_PAGES_KEY) and await self._redis.scard('cards'):
+            await self._redis.set(self.IMPORT_DONE_KEY, 1)
+            done = True
 
-            await self._redis.sadd('cards', *cards)
-            number = await self._redis.scard('cards')
+        if not done:
+            try:
+                await self.import_cards()
+            except Exception:
+                self._logger.exception('Card import stopped')
+                number = await self._redis.scard('cards')
+                return f'Stopped after {number} cards. /downloadcards again to continue'
 
+        number = await self._redis.scard('cards')
         return f'Downloaded {number}'
 
     async def command_randomcard(self, text, message, **kwargs):
-        while True:
-            card_name = await self._redis.srandmember('cards')
+        if not self._ready:
+            await self.fill()
+
+        if not self._ready:
+            return "Couldn't find a card with an image. Try again?"
 
-            image = await self._redis.hget('card_cache', card_name)
+        card_name, image = self._ready.popleft()
+        self.__refill()
 
-            if not image:
-                image = await self._get_image(card_name)
+        wiki_name = card_name.replace(' ', '_')
+        caption = f'{card_name} - http://yugioh.wikia.com/wiki/{wiki_name}'
+        response = await self._bot.send_photo(message['chat']['id'], image, caption=caption)
 
-            if image:
-                wiki_name = card_name.replace(' ', '_')
-                caption = f'{card_name} - http://yugioh.wikia.com/wiki/{wiki_name}'
-                response = await self._bot.send_photo(message['chat']['id'], image, caption=caption)
-                file_id = response['result']['photo'][0]['file_id']
-                await self._redis.hset('card_cache', card_name, file_id)
+        if response.get('ok'):
+            file_id = response['result']['photo'][0]['file_id']
+            self.defer(message).hset('card_cache', card_name, file_id)
+        else:
+            self._logger.error('Could not send %s: %s', card_name, response)
+            self.defer(message).hdel('card_cache', card_name)
 
-                return ''
+        return ''
 
     async def respond(self, text, message):
         command = message.get('command', None)
@@ -718,45 +1239,161 @@ class Quote(Command):
     CLEANUP_RE = re.compile(r'@\w+\s?')
 
     async def prepare(self):
+        json_path = os.path.join(config.MARKOV_PATH, 'trained.json')
+        self._chain_path = os.path.join(config.MARKOV_PATH, 'trained.chain')
+        self._live_path = os.path.join(config.MARKOV_PATH, 'live.chain')
+        self._executor = None
+        self._live_mtime = None
+        self.trainer = None
+        self.generator = markov.SentenceGenerator(config.QUOTE_WORKERS, config.QUOTE_MAX_JOBS,
+                                                  config.QUOTE_DEADLINE)
+        self.reservoir = markov.SentenceReservoir(self.generator, config.QUOTE_RESERVOIR_SIZE,
+                                                  config.QUOTE_RESERVOIR_REFILL)
+
         try:
-            async with aiofiles.open('/markov/trained.json') as f:
-                data = await f.read()
-                self.model = markovify.NewlineText.from_json(data)
-                self._logger.info('Loaded model!')
+            outdated = os.path.exists(json_path) and (not os.path.exists(self._chain_path) or
+                                                      os.path.getmtime(self._chain_path) < os.path.getmtime(json_path))
+
+            if outdated:
+                self._logger.info('Building %s from %s', self._chain_path, json_path)
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, markov.build_from_json, json_path, self._chain_path)
+
+            path = self._chain_path
+            self._live_mtime = self.__live_mtime()
+
+            if config.MARKOV_TRAINING and self._live_mtime and self._live_mtime > os.path.getmtime(self._chain_path):
+                path = self._live_path
+
+            self.model = markov.CompactText(path)
+            self.reservoir.reset(self.model)
+            self._logger.info('Loaded model!')
         except Exception as e:
             self._logger.exception("Couldn't load the model")
             self.model = None
 
-    def _handle_error(self, start='that'):
-        phrase = self.model.make_short_sentence(140)
+        if self.model and config.MARKOV_TRAINING:
+            self.trainer = markov.NgramTrainer(self._redis, self.model.state_size, config.MARKOV_BATCH)
+
+    async def cleanup(self):
+        if self.trainer:
+            await self.trainer.flush()
+
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+        self.reservoir.close()
+        self.generator.shutdown()
+
+    def observe(self, message):
+        if not self.trainer:
+            return
+
+        text = message['text']
+
+        if not text or text.startswith('/') or message.get('from', {}).get('is_bot'):
+            return
+
+        self.trainer.ingest(self.CLEANUP_RE.sub('', text))
+
+        if self.trainer.should_flush:
+            asyncio.ensure_future(self.trainer.flush())
+
+    @job(interval=60, jitter=10, lock=False)
+    async def flush_ngrams(self):
+        if self.trainer:
+            await self.trainer.flush()
+
+    @job(interval=config.MARKOV_RETRAIN_INTERVAL, jitter=60, timeout=600, warm_up=False)
+    async def retrain(self):
+        """ Merges what the chats said with the trained chain in a worker
+        process, which then decays the counts. One bot process does it per
+        interval, the others pick the new chain up in reload_model """
+        if not self.trainer:
+            return
+
+        await self.trainer.flush()
+
+        if not await self.trainer.snapshot():
+            return
+
+        if not self._executor:
+            self._executor = markov.process_pool(1)
+
+        loop = asyncio.get_event_loop()
+        states = await loop.run_in_executor(self._executor, markov.merge_ngrams, self._chain_path, self._live_path,
+                                            (config.REDIS_HOST, config.REDIS_PORT), config.MARKOV_DECAY,
+                                            config.MARKOV_MAX_NGRAMS)
+
+        if states:
+            self.__swap()
+            self._logger.info('Retrained the model with %s live states', states)
+
+    @job(interval=60, jitter=10, lock=False)
+    async def reload_model(self):
+        mtime = self.__live_mtime()
+
+        if self.trainer and mtime and mtime != self._live_mtime:
+            self.__swap()
+            self._logger.info('Loaded the model another process retrained')
+
+    def __live_mtime(self):
+        try:
+            return os.path.getmtime(self._live_path)
+        except OSError:
+            return None
+
+    def __swap(self):
+        self._live_mtime = self.__live_mtime()
+        self.model = markov.CompactText(self._live_path)
+        self.reservoir.reset(self.model)
+
+    async def _handle_error(self, start='that', generate=True):
+        # a sentence from the reservoir is free, a new one can take as long again
+        phrase = self.reservoir.pop()
+
+        if not phrase and generate:
+            try:
+                phrase = await self.generator.generate(self.model)
+            except Exception:
+                self._logger.exception('Could not make a random thought either')
+
+        if not phrase:
+            return f"I didn't understand {start}."
+
         return f"I didn't understand {start}. Here's a random thought: \"{phrase}\""
 
     async def respond(self, text, message):
         if not self.model:
             return "I don't have a model, sorry :("
 
-        if message.get('args'):
-            try:
-                start = "that"
-                start = message['args']['start']
+        start = None
 
-                if start.startswith('@ofensivaria'):
-                    start = self.CLEANUP_RE.sub('', start)
+        if message.get('args'):
+            start = message['args']['start']
 
-                if start:
-                    phrase = self.model.make_sentence_with_start(start, max_chars=140)
-                else:
-                    phrase = self.model.make_short_sentence(140)
+            if start.startswith('@ofensivaria'):
+                start = self.CLEANUP_RE.sub('', start)
 
-                if not phrase:
-                    return self._handle_error()
+        if not start:
+            phrase = self.reservoir.pop()
 
+            if phrase:
                 return phrase
-            except Exception:
-                self._logger.exception('wat')
-                return self._handle_error()
-        else:
-            return self.model.make_short_sentence(140)
+
+        try:
+            phrase = await self.generator.generate(self.model, start or None)
+        except asyncio.TimeoutError:
+            self._logger.warning('Took too long to make a sentence starting with %r', start)
+            return await self._handle_error(generate=False)
+        except Exception:
+            self._logger.exception('wat')
+            return await self._handle_error()
+
+        if not phrase:
+            return await self._handle_error()
+
+        return phrase
 
 
 class SpeedrunSchedule(Command):
@@ -765,6 +1402,7 @@ class SpeedrunSchedule(Command):
     LOCAL_TZ = pytz.timezone('America/Sao_Paulo')
     EVENT_TZ = pytz.timezone('America/Chicago')
     EVENT_ID = '7711pr96ji1e6x7a95'
+    CACHE_TTL = {'https://horaro.org/': 30}
 
     def _format_event(self, event, now=False):
         title = event['data'][0]
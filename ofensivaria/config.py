@@ -4,7 +4,89 @@ import logging
 DEBUG = os.getenv('DEBUG', '1') == '1'
 TOKEN = os.getenv('TOKEN', '')
 URL = os.getenv('URL', '')
+API_URL = os.getenv('API_URL', 'https://api.telegram.org')
 LOGGING_LEVEL = getattr(logging, os.getenv('LOGGING_LEVEL', 'INFO'), logging.INFO)
 
+# telegram user ids allowed to use admin commands, like /profile
+ADMINS = [int(i) for i in os.getenv('ADMINS', '').split(',') if i.strip()]
+
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+
+# number of updates processed at the same time. 0 processes them one by one.
+# on the web app, this also makes the webhook answer before processing the update
+WORKERS = int(os.getenv('WORKERS', '0'))
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '1000'))
+
+# seconds telegram holds getUpdates open waiting for new updates. 0 disables long
+# polling, and the poller sleeps between requests instead. inline queries need
+# inline mode turned on with @BotFather
+LONG_POLLING_TIMEOUT = int(os.getenv('LONG_POLLING_TIMEOUT', '30'))
+ALLOWED_UPDATES = os.getenv('ALLOWED_UPDATES', 'message,inline_query').split(',')
+MAX_BACKOFF = float(os.getenv('MAX_BACKOFF', '60'))
+
+# how many update ids below the newest one we keep to catch duplicated deliveries
+UPDATES_WINDOW = int(os.getenv('UPDATES_WINDOW', '1000'))
+
+# outgoing messages are throttled to stay under telegram's limits
+RATE_LIMIT = os.getenv('RATE_LIMIT', '1') == '1'
+GLOBAL_RATE = float(os.getenv('GLOBAL_RATE', '30'))
+CHAT_RATE = float(os.getenv('CHAT_RATE', '1'))
+CHAT_BURST = int(os.getenv('CHAT_BURST', '3'))
+OUTBOX_SIZE = int(os.getenv('OUTBOX_SIZE', '1000'))
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', '3'))
+
+# the first text answer to a webhook update goes back in the webhook response
+INLINE_REPLIES = os.getenv('INLINE_REPLIES', '0') == '1'
+INLINE_REPLY_TIMEOUT = float(os.getenv('INLINE_REPLY_TIMEOUT', '2'))
+
+# where the trained markov model for /quote lives
+MARKOV_PATH = os.getenv('MARKOV_PATH', '/markov')
+
+# learn from what the chats say and merge it into the /quote model from time to time
+MARKOV_TRAINING = os.getenv('MARKOV_TRAINING', '0') == '1'
+MARKOV_RETRAIN_INTERVAL = int(os.getenv('MARKOV_RETRAIN_INTERVAL', '3600'))
+MARKOV_BATCH = int(os.getenv('MARKOV_BATCH', '50'))
+MARKOV_MAX_NGRAMS = int(os.getenv('MARKOV_MAX_NGRAMS', '200000'))
+MARKOV_DECAY = float(os.getenv('MARKOV_DECAY', '0.9'))
+
+# /quote sentences are made on worker processes. 0 workers makes them on the event loop
+QUOTE_WORKERS = int(os.getenv('QUOTE_WORKERS', '2'))
+QUOTE_MAX_JOBS = int(os.getenv('QUOTE_MAX_JOBS', '4'))
+QUOTE_DEADLINE = float(os.getenv('QUOTE_DEADLINE', '1'))
+QUOTE_RESERVOIR_SIZE = int(os.getenv('QUOTE_RESERVOIR_SIZE', '50'))
+QUOTE_RESERVOIR_REFILL = int(os.getenv('QUOTE_RESERVOIR_REFILL', '10'))
+
+# responses commands get with http_get, see Command.CACHE_TTL
+HTTP_CACHE_SIZE = int(os.getenv('HTTP_CACHE_SIZE', '512'))
+HTTP_CACHE_REDIS = os.getenv('HTTP_CACHE_REDIS', '1') == '1'
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', '1024'))
+MEDIA_CACHE_SHARED_SIZE = int(os.getenv('MEDIA_CACHE_SHARED_SIZE', '20000'))
+
+# photos sent to imgur at the same time, and how big they get before going to disk
+IMGUR_UPLOADS = int(os.getenv('IMGUR_UPLOADS', '2'))
+IMGUR_SPOOL_SIZE = int(os.getenv('IMGUR_SPOOL_SIZE', str(1024 * 1024)))
+
+# /metrics, for prometheus. the poller serves it on METRICS_PORT, 0 turns that off.
+# scrapers can use METRICS_TOKEN instead of the telegram token on the web app
+METRICS = os.getenv('METRICS', '1') == '1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# how often we check how late the event loop is, and after how long stuck we log
+# what it's running. 0 doesn't watch for stalls
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.25'))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.5'))
+
+# /profile samples the event loop every PROFILE_INTERVAL seconds and writes the
+# stacks to PROFILE_DIR
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp')
+
+# appends every update handled to RECORD_PATH for the benchmarks to replay. ids are
+# hashed with RECORD_KEY and, with RECORD_SCRAMBLE, texts are scrambled. RECORD_SAMPLE
+# is the fraction of chats recorded
+RECORD_PATH = os.getenv('RECORD_PATH', '')
+RECORD_KEY = os.getenv('RECORD_KEY', TOKEN)
+RECORD_SCRAMBLE = os.getenv('RECORD_SCRAMBLE', '1') == '1'
+RECORD_SAMPLE = float(os.getenv('RECORD_SAMPLE', '1'))
@@ -0,0 +1,133 @@
+import re
+import time
+import logging
+
+from ofensivaria import config, metrics
+from ofensivaria.commands import Command, normalize_text
+
+
+class CommandDispatcher:
+    """ Picks which commands can answer a message before trying any of them.
+
+    Plain slash commands are indexed by name, commands with a REGEX are
+    checked all at once by a single combined regex and commands with a custom
+    can_respond are only tried when their prefilter accepts the message.
+    Candidates are processed in the same order the bot loaded them. """
+
+    SLASH_RE = re.compile(r'^/(\w+)')
+    BACKREFERENCE_RE = re.compile(r'\\\d|\(\?P=')
+
+    def __init__(self, bot, commands):
+        self._bot = bot
+        self._commands = list(commands)
+        self._slash = {}
+        self._regexes = []
+        self._custom = []
+        self._observers = [c for c in self._commands if type(c).observe is not Command.observe]
+        self._inline = [c for c in self._commands if type(c).inline is not Command.inline]
+        self._logger = logging.getLogger('dispatcher')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+        regexes = {}
+
+        for priority, command in enumerate(self._commands):
+            if type(command).can_respond is not Command.can_respond:
+                self._custom.append((priority, command))
+                self.__index_slash(priority, command)
+            elif command.REGEX:
+                if self.BACKREFERENCE_RE.search(command.REGEX.pattern):
+                    self._custom.append((priority, command))
+                else:
+                    regexes.setdefault(command.REGEX.flags, []).append((priority, command))
+            elif command.SLASH_COMMAND:
+                self.__index_slash(priority, command)
+
+        for flags, commands in regexes.items():
+            self.__combine(flags, commands)
+
+    def __index_slash(self, priority, command):
+        for name in command.slash_names:
+            self._slash.setdefault(name, []).append(priority)
+
+    def __combine(self, flags, commands):
+        # every pattern becomes an optional lookahead from the start of the
+        # text, so one match tells us which of them would find something
+        groups = []
+        parts = []
+
+        for priority, command in commands:
+            group = '_c%d' % priority
+            parts.append(r'(?:(?=[\s\S]*?(?P<%s>%s)))?' % (group, command.REGEX.pattern))
+            groups.append((group, priority))
+
+        try:
+            regex = re.compile(''.join(parts), flags)
+        except re.error:
+            self._logger.exception('Could not combine regexes, trying them one by one')
+            self._custom.extend(commands)
+            self._custom.sort(key=lambda c: c[0])
+            return
+
+        self._regexes.append((regex, groups))
+
+    def candidates(self, text, message):
+        found = set()
+
+        match = self.SLASH_RE.match(text)
+
+        if match:
+            # /command@botname ends up here as just "command"
+            found.update(self._slash.get(match.group(1).lower(), ()))
+
+        for regex, groups in self._regexes:
+            match = regex.match(text)
+            found.update(priority for group, priority in groups if match.group(group) is not None)
+
+        for priority, command in self._custom:
+            if priority not in found and command.prefilter(text, message):
+                found.add(priority)
+
+        return [self._commands[priority] for priority in sorted(found)]
+
+    async def dispatch(self, message):
+        start = time.monotonic()
+        handled = False
+
+        try:
+            handled = await self.__dispatch(message)
+            return handled
+        finally:
+            metrics.DISPATCH.observe(time.monotonic() - start, 'handled' if handled else 'ignored')
+
+    async def __dispatch(self, message):
+        text = normalize_text(message)
+
+        for command in self._observers:
+            try:
+                command.observe(message)
+            except Exception as e:
+                self._logger.exception(e)
+
+        for command in self.candidates(text, message):
+            try:
+                response = await command.process(self._bot, message)
+
+                if response:
+                    return True
+            except Exception as e:
+                self._logger.exception(e)
+
+        return False
+
+    async def dispatch_inline(self, query):
+        """ Returns the results of the first command that answers the inline query """
+        for command in self._inline:
+            try:
+                results = await command.inline(query)
+
+                if results:
+                    return results
+            except Exception as e:
+                self._logger.exception(e)
+
+        return []
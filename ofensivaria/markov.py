@@ -0,0 +1,560 @@
+""" A compact, memory mapped version of a markovify chain.
+
+The file has an interned token table sorted by its utf-8 bytes, the chain
+states sorted by their token ids and, for every state, the ids of the words
+that can follow it with their cumulative weights. Everything is an array of
+native unsigned ints, so loading is just mapping the file and processes
+loading the same file share its pages.
+
+To build one from a model saved with markovify's to_json:
+
+    python -m ofensivaria.markov /markov/trained.json /markov/trained.chain
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import array
+import bisect
+import random
+import struct
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+BEGIN = '___BEGIN__'
+END = '___END__'
+
+MAGIC = b'OFMK'
+VERSION = 1
+BYTE_ORDER = 0x01020304
+HEADER = struct.Struct('=4sIIIIIII')
+
+WORD_SPLIT_RE = re.compile(r'\s+')
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def read_json_chain(path):
+    """ Reads a markovify model saved with to_json. Returns the state size
+    and the chain as a dict of {state: {word: count}} """
+    with open(path) as f:
+        obj = json.load(f)
+
+    chain = obj['chain']
+
+    if isinstance(chain, str):
+        chain = json.loads(chain)
+
+    return obj['state_size'], {tuple(state): counts for state, counts in chain}
+
+
+def write_chain(chain, state_size, path):
+    """ Writes {state: {word: count}} to path, atomically """
+    words = set()
+
+    for state, counts in chain.items():
+        words.update(state)
+        words.update(counts)
+
+    words.update((BEGIN, END))
+    tokens = sorted(word.encode('utf8') for word in words)
+    ids = {token.decode('utf8'): i for i, token in enumerate(tokens)}
+
+    token_offsets = array.array('I', [0])
+
+    for token in tokens:
+        token_offsets.append(token_offsets[-1] + len(token))
+
+    token_bytes = b''.join(tokens)
+
+    rows = sorted((tuple(ids[word] for word in state), counts) for state, counts in chain.items())
+
+    states = array.array('I')
+    state_offsets = array.array('I', [0])
+    next_tokens = array.array('I')
+    cumulative = array.array('I')
+
+    for state, counts in rows:
+        states.extend(state)
+        total = 0
+
+        for word, count in sorted(counts.items()):
+            total += int(count)
+            next_tokens.append(ids[word])
+            cumulative.append(total)
+
+        state_offsets.append(len(next_tokens))
+
+    header = HEADER.pack(MAGIC, VERSION, BYTE_ORDER, state_size, len(tokens),
+                         len(rows), len(next_tokens), len(token_bytes))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_pad(header))
+            f.write(token_offsets.tobytes())
+            f.write(_pad(token_bytes))
+            f.write(states.tobytes())
+            f.write(state_offsets.tobytes())
+            f.write(next_tokens.tobytes())
+            f.write(cumulative.tobytes())
+
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def build_from_json(json_path, path):
+    state_size, chain = read_json_chain(json_path)
+    write_chain(chain, state_size, path)
+
+
+def merge_chains(base_path, live, path):
+    """ Writes the chain at base_path plus the live {state: {word: count}} to path.
+    Heavy, so it's meant to run on a process pool """
+    base = CompactChain(base_path)
+    chain = dict(base.iter_chain())
+
+    for state, counts in live.items():
+        merged = chain.setdefault(state, {})
+
+        for word, count in counts.items():
+            merged[word] = merged.get(word, 0) + count
+
+    write_chain(chain, base.state_size, path)
+
+
+class CompactChain:
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.version = os.fstat(f.fileno()).st_mtime_ns
+
+        view = memoryview(self._mmap)
+        magic, version, byte_order, state_size, tokens, states, transitions, token_bytes = \
+            HEADER.unpack_from(view)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a chain file' % path)
+
+        if byte_order != BYTE_ORDER:
+            raise ValueError('%s was built on a machine with another byte order' % path)
+
+        self.state_size = state_size
+        self.tokens = tokens
+        self.states = states
+        position = len(_pad(b'\0' * HEADER.size))
+
+        def section(length, fmt='I'):
+            nonlocal position
+            size = length * (4 if fmt == 'I' else 1)
+            data = view[position:position + size]
+            position += size + (-size % 4)
+            return data.cast(fmt) if fmt == 'I' else data
+
+        self._token_offsets = section(tokens + 1)
+        self._token_bytes = section(token_bytes, 'B')
+        self._states = section(states * state_size)
+        self._state_offsets = section(states + 1)
+        self._next_tokens = section(transitions)
+        self._cumulative = section(transitions)
+
+        self.begin = self.token_id(BEGIN)
+        self.end = self.token_id(END)
+
+    def __token_bytes(self, id):
+        return bytes(self._token_bytes[self._token_offsets[id]:self._token_offsets[id + 1]])
+
+    def token(self, id):
+        return self.__token_bytes(id).decode('utf8')
+
+    def token_id(self, word):
+        word = word.encode('utf8')
+        lo, hi = 0, self.tokens
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            token = self.__token_bytes(mid)
+
+            if token == word:
+                return mid
+            elif token < word:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        raise KeyError(word.decode('utf8'))
+
+    def __state(self, index):
+        start = index * self.state_size
+        return tuple(self._states[start:start + self.state_size])
+
+    def state_index(self, state):
+        lo, hi = 0, self.states
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self.__state(mid)
+
+            if current == state:
+                return mid
+            elif current < state:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        raise KeyError(state)
+
+    def move(self, state):
+        index = self.state_index(state)
+        lo, hi = self._state_offsets[index], self._state_offsets[index + 1]
+        r = random.random() * self._cumulative[hi - 1]
+        return self._next_tokens[bisect.bisect(self._cumulative, r, lo, hi)]
+
+    def walk(self, init_state=None):
+        """ Returns a list of words, starting from a tuple of words """
+        if init_state:
+            state = tuple(self.token_id(word) for word in init_state)
+        else:
+            state = (self.begin,) * self.state_size
+
+        words = []
+
+        while True:
+            word = self.move(state)
+
+            if word == self.end:
+                return words
+
+            words.append(self.token(word))
+            state = state[1:] + (word,)
+
+    def iter_chain(self):
+        """ Yields every state and its {word: count}, as the builder expects """
+        for index in range(self.states):
+            state = tuple(self.token(id) for id in self.__state(index))
+            lo, hi = self._state_offsets[index], self._state_offsets[index + 1]
+            counts = {}
+            previous = 0
+
+            for position in range(lo, hi):
+                counts[self.token(self._next_tokens[position])] = self._cumulative[position] - previous
+                previous = self._cumulative[position]
+
+            yield state, counts
+
+
+class CompactText:
+    """ Generates sentences like markovify.NewlineText does, from a CompactChain """
+
+    def __init__(self, path):
+        self.chain = CompactChain(path)
+        self.state_size = self.chain.state_size
+
+    @property
+    def path(self):
+        return self.chain.path
+
+    @property
+    def version(self):
+        return self.chain.version
+
+    def word_split(self, sentence):
+        return [word for word in WORD_SPLIT_RE.split(sentence) if word]
+
+    def word_join(self, words):
+        return ' '.join(words)
+
+    def make_sentence(self, init_state=None, tries=10, max_chars=None):
+        prefix = [word for word in init_state or () if word != BEGIN]
+
+        for _ in range(tries):
+            sentence = self.word_join(prefix + self.chain.walk(init_state))
+
+            if max_chars is None or len(sentence) <= max_chars:
+                return sentence
+
+        return None
+
+    def make_short_sentence(self, max_chars, **kwargs):
+        return self.make_sentence(max_chars=max_chars, **kwargs)
+
+    def make_sentence_with_start(self, beginning, **kwargs):
+        split = tuple(self.word_split(beginning))
+        word_count = len(split)
+
+        if word_count == self.state_size:
+            init_state = split
+        elif 0 < word_count < self.state_size:
+            init_state = (BEGIN,) * (self.state_size - word_count) + split
+        else:
+            raise ValueError('This model needs a start with 1 to {} words, got {}'.format(self.state_size, word_count))
+
+        return self.make_sentence(init_state, **kwargs)
+
+
+# models loaded by each worker process, by path
+_models = {}
+
+
+def generate(model, start=None, max_chars=140):
+    if start:
+        return model.make_sentence_with_start(start, max_chars=max_chars)
+
+    return model.make_short_sentence(max_chars)
+
+
+def _generate_in_worker(path, version, start=None, max_chars=140):
+    model = _models.get(path)
+
+    # the file may have been swapped for a newer model since we loaded it
+    if model is None or model.version < version:
+        model = _models[path] = CompactText(path)
+
+    return generate(model, start, max_chars)
+
+
+def process_pool(workers):
+    """ A process pool whose workers start from a clean process, instead of
+    forking the bot with its threads, sockets and event loop """
+    try:
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+    except TypeError:
+        # no mp_context before python 3.7, the default start method it is
+        multiprocessing.set_start_method('forkserver', force=True)
+        return ProcessPoolExecutor(workers)
+
+
+class SentenceGenerator:
+    """ Generates sentences on a pool of worker processes, which map the model
+    once and share its pages, so a slow walk never blocks the event loop.
+
+    At most `max_jobs` generations run or wait for a worker at the same time,
+    and each one has `deadline` seconds to finish before we give up on it. """
+
+    def __init__(self, workers=2, max_jobs=4, deadline=1.0):
+        self._executor = process_pool(workers) if workers else None
+        self._jobs = asyncio.Semaphore(max_jobs)
+        self._deadline = deadline
+
+    async def generate(self, model, start=None, max_chars=140):
+        if not self._executor:
+            return generate(model, start, max_chars)
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._deadline
+
+        await asyncio.wait_for(self._jobs.acquire(), self._deadline)
+
+        # the slot is only given back when the worker is done, even if we
+        # stopped waiting for it before that
+        try:
+            job = self._executor.submit(_generate_in_worker, model.path, model.version, start, max_chars)
+        except Exception:
+            self._jobs.release()
+            raise
+
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._jobs.release))
+
+        return await asyncio.wait_for(asyncio.wrap_future(job), max(0, deadline - loop.time()))
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+
+class SentenceReservoir:
+    """ Sentences made ahead of time, so answering a /quote without a start is
+    just taking one of them. Refilled in the background, one sentence at a
+    time, whenever it gets down to `refill_at`, and emptied when the model
+    changes. """
+
+    def __init__(self, generator, size=50, refill_at=10):
+        self._generator = generator
+        self._size = size
+        self._refill_at = refill_at
+        self._sentences = deque()
+        self._model = None
+        self._filling = None
+        self._logger = logging.getLogger('command')
+
+    def __len__(self):
+        return len(self._sentences)
+
+    def reset(self, model):
+        self._model = model
+        self._sentences.clear()
+        self.refill()
+
+    def pop(self):
+        try:
+            sentence = self._sentences.popleft()
+        except IndexError:
+            sentence = None
+
+        if len(self._sentences) <= self._refill_at:
+            self.refill()
+
+        return sentence
+
+    def refill(self):
+        if self._size and self._model and (self._filling is None or self._filling.done()):
+            self._filling = asyncio.ensure_future(self.__fill())
+
+    async def __fill(self):
+        model = self._model
+
+        while self._model is model and len(self._sentences) < self._size:
+            try:
+                sentence = await self._generator.generate(model)
+            except Exception:
+                self._logger.exception('Could not fill the sentence reservoir')
+                return
+
+            # the model changed while we were waiting for this one
+            if self._model is not model:
+                return
+
+            if sentence:
+                self._sentences.append(sentence)
+
+            # let everyone else run between sentences
+            await asyncio.sleep(0)
+
+    def close(self):
+        if self._filling:
+            self._filling.cancel()
+
+
+class NgramTrainer:
+    """ Counts the n-grams of live chat messages in a redis hash, which is
+    merged with the trained chain from time to time to make a new model.
+
+    Messages are counted in memory and written in batches. After every merge
+    the counts decay and only the most common n-grams are kept, so old talk
+    fades away and the hash stays bounded. Counts are floats, so something
+    said once lasts a few merges instead of rounding down to nothing. """
+
+    KEY = 'bot:markov:ngrams'
+    SNAPSHOT_KEY = 'bot:markov:ngrams:snapshot'
+    SEPARATOR = '\x1f'
+
+    # decayed counts below this are forgotten
+    MIN_COUNT = 0.05
+
+    def __init__(self, redis, state_size, batch_size=50):
+        self._redis = redis
+        self._state_size = state_size
+        self._batch_size = batch_size
+        self._buffer = Counter()
+        self._messages = 0
+
+    @property
+    def should_flush(self):
+        return self._messages >= self._batch_size
+
+    def ingest(self, text):
+        words = [word for word in WORD_SPLIT_RE.split(text) if word]
+
+        if not words:
+            return
+
+        words = [BEGIN] * self._state_size + words + [END]
+
+        for i in range(len(words) - self._state_size):
+            self._buffer[self.SEPARATOR.join(words[i:i + self._state_size + 1])] += 1
+
+        self._messages += 1
+
+    async def flush(self):
+        if not self._buffer:
+            return
+
+        buffer, self._buffer, self._messages = self._buffer, Counter(), 0
+
+        pipeline = self._redis.pipeline()
+
+        for ngram, count in buffer.items():
+            pipeline.hincrbyfloat(self.KEY, ngram, count)
+
+        await pipeline.execute()
+
+    async def snapshot(self):
+        """ Sets everything counted so far aside for merge_ngrams, while new
+        counts go to a fresh hash. False when there's nothing to merge """
+        # a merge that died halfway left its snapshot, which goes first
+        if await self._redis.exists(self.SNAPSHOT_KEY):
+            return True
+
+        try:
+            await self._redis.rename(self.KEY, self.SNAPSHOT_KEY)
+        except Exception:
+            return False
+
+        return True
+
+
+def merge_ngrams(base_path, path, address, decay=0.9, max_ngrams=200000):
+    """ Writes the chain at base_path plus the n-grams NgramTrainer.snapshot
+    set aside to path, then hands them back to the trainer decayed. It talks
+    to redis itself, so the big hash never goes through the bot's event loop.
+    Meant to run on a process pool. Returns how many live states it merged """
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(_merge_ngrams(base_path, path, address, decay, max_ngrams, loop))
+    finally:
+        loop.close()
+
+
+async def _merge_ngrams(base_path, path, address, decay, max_ngrams, loop):
+    # only the bot needs redis, building a chain from json doesn't
+    import aioredis
+
+    redis = await aioredis.create_redis(address, encoding='utf8', loop=loop)
+
+    try:
+        counts = await redis.hgetall(NgramTrainer.SNAPSHOT_KEY)
+        live = {}
+
+        for ngram, count in counts.items():
+            words = ngram.split(NgramTrainer.SEPARATOR)
+            live.setdefault(tuple(words[:-1]), {})[words[-1]] = max(1, int(round(float(count))))
+
+        if live:
+            merge_chains(base_path, live, path)
+
+        # only now that the chain has them, the counts fade
+        counts = ((ngram, float(count) * decay) for ngram, count in counts.items())
+        counts = sorted((c for c in counts if c[1] >= NgramTrainer.MIN_COUNT), key=lambda c: c[1], reverse=True)
+
+        pipeline = redis.pipeline()
+
+        for ngram, count in counts[:max_ngrams]:
+            pipeline.hincrbyfloat(NgramTrainer.KEY, ngram, count)
+
+        pipeline.delete(NgramTrainer.SNAPSHOT_KEY)
+        await pipeline.execute()
+
+        return len(live)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    build_from_json(sys.argv[1], sys.argv[2])
@@ -0,0 +1,248 @@
+import time
+import asyncio
+import logging
+
+from bisect import bisect_left
+
+from ofensivaria import config
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.TYPE)
+
+        for values, value in sorted(self.collect()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, values), value)
+
+    def collect(self):
+        return self._values.items()
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """ Either set by hand or read from a function returning {labels: value}
+    every time the metrics are rendered """
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self._function = function
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def watch(self, function):
+        self._function = function
+
+    def collect(self):
+        if not self._function:
+            return self._values.items()
+
+        try:
+            return self._function().items()
+        except Exception:
+            logging.getLogger('metrics').exception('Could not collect %s', self.name)
+            return ()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        try:
+            counts = self._values[labels]
+        except KeyError:
+            # one count per bucket, +Inf, then the sum
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.TYPE)
+
+        for values, counts in sorted(self._values.items()):
+            total = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '%s_bucket%s %s' % (self.name, _labels(self.labels, values, [('le', bound)]), total)
+
+            yield '%s_sum%s %s' % (self.name, _labels(self.labels, values), counts[-1])
+            yield '%s_count%s %s' % (self.name, _labels(self.labels, values), total)
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.register(Counter(
+    'bot_updates_total', 'Updates handled, by kind', ('kind',)))
+DISPATCH = REGISTRY.register(Histogram(
+    'bot_dispatch_seconds', 'Time to dispatch a message to every candidate command', ('outcome',)))
+COMMANDS = REGISTRY.register(Histogram(
+    'bot_command_seconds', 'Time commands take to respond and send their answer', ('command', 'outcome')))
+TELEGRAM = REGISTRY.register(Histogram(
+    'bot_telegram_request_seconds', 'Bot API requests, by method', ('method', 'outcome')))
+HTTP = REGISTRY.register(Histogram(
+    'bot_http_request_seconds', 'Requests commands make to other services, by host', ('host', 'method', 'outcome')))
+REDIS = REGISTRY.register(Histogram(
+    'bot_redis_command_seconds', 'Redis round trips, by command', ('command', 'outcome'),
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)))
+LOOP_LAG = REGISTRY.register(Histogram(
+    'bot_loop_lag_seconds', 'How late the event loop woke up from a short sleep',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5)))
+QUEUES = REGISTRY.register(Gauge(
+    'bot_queue', 'Updates and messages waiting or being handled', ('queue',)))
+CACHES = REGISTRY.register(Gauge(
+    'bot_cache_lookups', 'Cache lookups since starting, by result', ('cache', 'result')))
+
+
+async def _timed(name, start, coroutine):
+    outcome = 'error'
+
+    try:
+        result = await coroutine
+        outcome = 'ok'
+        return result
+    finally:
+        REDIS.observe(time.monotonic() - start, name, outcome)
+
+
+def _timed_future(name, start, future):
+    outcome = 'error' if future.cancelled() or future.exception() else 'ok'
+    REDIS.observe(time.monotonic() - start, name, outcome)
+
+
+class InstrumentedTransaction:
+    """ Commands queued on a multi_exec or a pipeline only go out on execute,
+    so that's timed as a single round trip """
+
+    def __init__(self, name, transaction):
+        self._name = name
+        self._transaction = transaction
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def execute(self, *args, **kwargs):
+        return _timed(self._name, time.monotonic(), self._transaction.execute(*args, **kwargs))
+
+
+class InstrumentedRedis:
+    """ Times every command sent through the wrapped redis connection """
+
+    TRANSACTIONS = ('multi_exec', 'pipeline')
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def __getattr__(self, name):
+        attribute = getattr(self._redis, name)
+
+        if not callable(attribute):
+            return attribute
+
+        if name in self.TRANSACTIONS:
+            def wrapper(*args, **kwargs):
+                return InstrumentedTransaction(name, attribute(*args, **kwargs))
+        else:
+            def wrapper(*args, **kwargs):
+                start = time.monotonic()
+                result = attribute(*args, **kwargs)
+
+                if asyncio.isfuture(result):
+                    result.add_done_callback(lambda f: _timed_future(name, start, f))
+                elif asyncio.iscoroutine(result):
+                    result = _timed(name, start, result)
+
+                return result
+
+        # the next lookup finds it without going through __getattr__
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+async def _serve(reader, writer):
+    try:
+        request = await reader.readline()
+
+        # we don't care about the headers
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request.decode('latin1').split()
+
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', REGISTRY.render()
+        else:
+            status, body = '404 Not Found', 'not found\n'
+
+        body = body.encode('utf8')
+        writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode('latin1'))
+        writer.write(body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host='0.0.0.0', port=None):
+    """ A tiny http server for /metrics, for when there's no web app around """
+    port = port or config.METRICS_PORT
+    logging.getLogger('metrics').info('Serving metrics on %s:%s', host, port)
+    return await asyncio.start_server(_serve, host, port)
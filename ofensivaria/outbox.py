@@ -0,0 +1,215 @@
+import time
+import bisect
+import asyncio
+import logging
+
+from itertools import count
+
+from ofensivaria import config
+
+NORMAL, LOW = 0, 1
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def __refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def is_idle(self):
+        return self.tokens >= self.capacity and self.blocked_until <= time.monotonic()
+
+    def delay(self, now):
+        """ Seconds until there's a token to take """
+        self.__refill(now)
+        wait = max(0, self.blocked_until - now)
+
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+
+        return wait
+
+    def take(self, now):
+        self.__refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+
+class Delivery:
+    __slots__ = ('chat_id', 'method', 'data', 'future', 'attempts')
+
+    def __init__(self, chat_id, method, data, future):
+        self.chat_id = chat_id
+        self.method = method
+        self.data = data
+        self.future = future
+        self.attempts = 0
+
+
+class Outbox:
+    """ Sends requests to telegram respecting its rate limits.
+
+    Deliveries wait for a token from their chat's bucket and from the global
+    bucket, go out by priority and then by arrival, and one chat never has two
+    deliveries in flight, so a chat gets its messages in order. 429 answers
+    are retried after the `retry_after` telegram asks for. Callers wait until
+    their request was actually sent and get telegram's response back. """
+
+    def __init__(self, send, global_rate=30, chat_rate=1, chat_burst=3, max_size=1000, max_retries=3):
+        self._send = send
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_size = max_size
+        self._max_retries = max_retries
+        self._pending = []
+        self._chats = {}
+        self._busy = set()
+        self._sequence = count()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = None
+        self._logger = logging.getLogger('outbox')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    @property
+    def in_flight(self):
+        return len(self._busy)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.__run())
+
+    async def send(self, chat_id, method, data, priority=NORMAL):
+        while len(self._pending) >= self._max_size:
+            self._space.clear()
+            await self._space.wait()
+
+        future = asyncio.get_event_loop().create_future()
+        self.__push(priority, next(self._sequence), Delivery(chat_id, method, data, future))
+
+        return await future
+
+    def __push(self, priority, sequence, delivery):
+        bisect.insort(self._pending, (priority, sequence, delivery))
+        self._wakeup.set()
+
+    def __bucket(self, chat_id):
+        try:
+            return self._chats[chat_id]
+        except KeyError:
+            if len(self._chats) > 1000:
+                self._chats = {c: b for c, b in self._chats.items() if c in self._busy or not b.is_idle}
+
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+            return bucket
+
+    def __next(self, now):
+        """ Returns the position of the first delivery that can go out now or
+        how long until one of them can """
+        wait = None
+        checked = set()
+
+        for position, (_, _, delivery) in enumerate(self._pending):
+            chat_id = delivery.chat_id
+
+            if chat_id in self._busy or chat_id in checked:
+                continue
+
+            checked.add(chat_id)
+            delay = self.__bucket(chat_id).delay(now)
+
+            if not delay:
+                return position, None
+
+            wait = delay if wait is None else min(wait, delay)
+
+        return None, wait
+
+    async def __run(self):
+        while True:
+            now = time.monotonic()
+            position, wait = self.__next(now)
+
+            if position is None:
+                self._wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            delay = self._global.delay(now)
+
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            priority, sequence, delivery = self._pending.pop(position)
+            self._space.set()
+
+            if delivery.future.done():
+                continue
+
+            self._global.take(now)
+            self.__bucket(delivery.chat_id).take(now)
+            self._busy.add(delivery.chat_id)
+
+            asyncio.ensure_future(self.__deliver(priority, sequence, delivery))
+
+    @staticmethod
+    def retry_after(response):
+        try:
+            if response.get('error_code') == 429:
+                return response['parameters']['retry_after']
+        except (AttributeError, KeyError, TypeError):
+            pass
+
+        return None
+
+    async def __deliver(self, priority, sequence, delivery):
+        try:
+            response = await self._send(delivery.method, delivery.data)
+        except Exception as e:
+            if not delivery.future.done():
+                delivery.future.set_exception(e)
+        else:
+            retry_after = self.retry_after(response)
+
+            if retry_after is not None and delivery.attempts < self._max_retries:
+                self._logger.warning('Throttled on chat %s, retrying in %ss', delivery.chat_id, retry_after)
+                delivery.attempts += 1
+                self.__bucket(delivery.chat_id).block(retry_after, time.monotonic())
+                self.__push(priority, sequence, delivery)
+            elif not delivery.future.done():
+                delivery.future.set_result(response)
+        finally:
+            self._busy.discard(delivery.chat_id)
+            self._wakeup.set()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+        for _, _, delivery in self._pending:
+            if not delivery.future.done():
+                delivery.future.cancel()
+
+        self._pending = []
@@ -1,6 +1,7 @@
 import asyncio
 import uvloop
 
+from ofensivaria import config, metrics
 from ofensivaria.bot import TelegramBot
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -8,6 +9,10 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 async def main(bot):
     await bot.setup()
+
+    if config.METRICS and config.METRICS_PORT:
+        await metrics.serve(port=config.METRICS_PORT)
+
     await bot.polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from collections import Counter
+
+from ofensivaria import config, metrics
+
+
+def _thread_frame(thread_id):
+    return sys._current_frames().get(thread_id)
+
+
+def _running_command(frame):
+    """ The name of the command whose code is on the stack, if any """
+    # no imports here, the watchdog runs while the loop thread may hold the import lock
+    commands = sys.modules.get('ofensivaria.commands')
+
+    while commands and frame is not None:
+        instance = frame.f_locals.get('self')
+
+        if isinstance(instance, commands.Command):
+            return type(instance).__name__
+
+        frame = frame.f_back
+
+    return None
+
+
+class LoopMonitor:
+    """ Measures how late the event loop wakes up from a short sleep.
+
+    A watchdog thread also checks when the loop last woke up, and if it's stuck
+    for longer than `threshold` seconds, logs what the loop thread is running,
+    once per stall. """
+
+    def __init__(self, interval=0.25, threshold=0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_lag = 0
+        self.max_lag = 0
+        self.stalls = 0
+        self._beat = None
+        self._task = None
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._logger = logging.getLogger('loop-monitor')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.ensure_future(self.__heartbeat())
+
+        if self.threshold:
+            self._thread = threading.Thread(target=self.__watch, name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    async def __heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+
+            now = time.monotonic()
+            self._beat = now
+            self.last_lag = max(0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            metrics.LOOP_LAG.observe(self.last_lag)
+
+    def __watch(self):
+        reported = None
+
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._beat
+            stuck = time.monotonic() - beat
+
+            if stuck < self.threshold or reported == beat:
+                continue
+
+            reported = beat
+            self.stalls += 1
+            frame = _thread_frame(self._thread_id)
+
+            if frame is None:
+                continue
+
+            try:
+                self._logger.warning('Event loop stuck for %.3fs running %s:\n%s', stuck,
+                                     _running_command(frame) or 'no command',
+                                     ''.join(traceback.format_stack(frame)))
+            except Exception:
+                self._logger.exception('Could not tell what the event loop is running')
+            finally:
+                del frame
+
+    def stats(self):
+        return dict(last_lag=self.last_lag, max_lag=self.max_lag, stalls=self.stalls)
+
+    async def close(self):
+        self._stopped.set()
+
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class SamplingProfiler:
+    """ Samples the stack of the event loop thread every `interval` seconds
+    from another thread, while it's running.
+
+    Stacks are written in the collapsed format flamegraph.pl and speedscope
+    read, one `outer;inner count` line per distinct stack. """
+
+    def __init__(self, interval=0.005, directory='/tmp'):
+        self.interval = interval
+        self.directory = directory
+        self.started = None
+        self._samples = Counter()
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._logger = logging.getLogger('profiler')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def samples(self):
+        return sum(self._samples.values())
+
+    def start(self):
+        if self.running:
+            return False
+
+        self._samples.clear()
+        self._stopped.clear()
+        self._thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self.__sample, name='profiler', daemon=True)
+        self._thread.start()
+        self.started = time.time()
+        return True
+
+    @staticmethod
+    def __label(code):
+        # ; separates frames in the collapsed format
+        return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def __sample(self):
+        labels = {}
+
+        while not self._stopped.wait(self.interval):
+            frame = _thread_frame(self._thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+
+                try:
+                    stack.append(labels[code])
+                except KeyError:
+                    stack.append(labels.setdefault(code, self.__label(code).replace(';', ':')))
+
+                frame = frame.f_back
+
+            self._samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """ Stops sampling and returns the path of the file with the stacks """
+        if not self.running:
+            return None
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+        path = os.path.join(self.directory, 'profile-%s.collapsed' % time.strftime('%Y%m%d-%H%M%S'))
+
+        with open(path, 'w') as f:
+            for stack, count in self._samples.most_common():
+                f.write('%s %s\n' % (stack, count))
+
+        self._logger.info('Wrote %s samples to %s', self.samples, path)
+        return path
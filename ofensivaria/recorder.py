@@ -0,0 +1,152 @@
+import re
+import hmac
+import json
+import time
+import random
+import string
+import hashlib
+import logging
+
+from ofensivaria import config
+
+
+class TrafficRecorder:
+    """ Appends the updates the bot handles to a file, one json per line, so
+    they can be replayed by the benchmarks later.
+
+    Chat and user ids are replaced by an HMAC of them, so a chat keeps the same
+    id across the whole file without telling who it is. Names are dropped and,
+    with scramble, every letter and digit of the text is replaced by a random
+    one, keeping its length, spaces, punctuation and the /command itself.
+    Mentions of anyone but the bot are hashed, scrambled or not. Each line
+    also says how many messages the bot answered with. """
+
+    # fields of a message worth replaying, besides text, chat and from
+    MESSAGE_FIELDS = ('message_id', 'date')
+
+    # the bot's own, which commands look for. every other mention is hashed
+    KEPT_MENTIONS = ('@ofensivaria_bot',)
+    MENTION_RE = re.compile(r'@\w+')
+
+    def __init__(self, path, key, scramble=True, sample=1.0, flush_every=1.0):
+        self.path = path
+        self.scramble = scramble
+        self.sample = sample
+        self.recorded = 0
+        self._key = key.encode('utf8')
+        self._file = open(path, 'a', encoding='utf8', buffering=64 * 1024)
+        self._flush_every = flush_every
+        self._flushed = time.monotonic()
+        self._logger = logging.getLogger('recorder')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    def hash_id(self, value):
+        """ A stable 48 bit stand-in for the id, negative for negative ids
+        since those are groups """
+        digest = hmac.new(self._key, str(value).encode('utf8'), hashlib.sha256).digest()
+        hashed = int.from_bytes(digest[:6], 'big')
+        return -hashed if value < 0 else hashed
+
+    def hash_text(self, value):
+        return hmac.new(self._key, value.encode('utf8'), hashlib.sha256).hexdigest()[:32]
+
+    @staticmethod
+    def __scramble_word(word):
+        if word.startswith(('/', '@')):
+            return word
+
+        # keeps the extension, so names ending in .gif still look like gifs
+        stem, dot, extension = word.rpartition('.') if '.' in word[1:] else (word, '', '')
+        letters = []
+
+        for char in stem:
+            if char.isdigit():
+                letters.append(random.choice(string.digits))
+            elif char.isalpha():
+                letters.append(random.choice(string.ascii_uppercase if char.isupper() else string.ascii_lowercase))
+            else:
+                letters.append(char)
+
+        return ''.join(letters) + dot + extension
+
+    def __mention(self, match):
+        mention = match.group(0)
+
+        if mention.lower() in self.KEPT_MENTIONS:
+            return mention
+
+        return '@u' + self.hash_text(mention.lower())[:10]
+
+    def text(self, value):
+        value = self.MENTION_RE.sub(self.__mention, value)
+
+        if not self.scramble:
+            return value
+
+        return ' '.join(self.__scramble_word(word) for word in value.split(' '))
+
+    def __user(self, user):
+        return dict(id=self.hash_id(user.get('id', 0)), first_name='user', is_bot=user.get('is_bot', False))
+
+    def __message(self, message):
+        chat = message.get('chat') or {}
+        recorded = {field: message[field] for field in self.MESSAGE_FIELDS if field in message}
+        recorded['chat'] = dict(id=self.hash_id(chat.get('id', 0)), type=chat.get('type'))
+
+        if 'from' in message:
+            recorded['from'] = self.__user(message['from'])
+
+        if 'text' in message:
+            recorded['text'] = self.text(message['text'])
+
+        if 'photo' in message:
+            recorded['photo'] = [dict(file_id=self.hash_text(p.get('file_id', '')), width=p.get('width'),
+                                      height=p.get('height')) for p in message['photo']]
+
+        return recorded
+
+    def capture(self, update):
+        """ An anonymized copy of the update, taken before commands change it.
+        None when the update isn't sampled """
+        message = update.get('message')
+        inline_query = update.get('inline_query')
+        recorded = dict(update_id=update.get('update_id'))
+
+        if message:
+            recorded['message'] = self.__message(message)
+            chat_id = recorded['message']['chat']['id']
+        elif inline_query:
+            recorded['inline_query'] = dict(id=self.hash_text(inline_query.get('id', '')),
+                                            query=self.text(inline_query.get('query', '')),
+                                            offset=inline_query.get('offset', ''),
+                                            **{'from': self.__user(inline_query.get('from') or {})})
+            chat_id = recorded['inline_query']['from']['id']
+        else:
+            # only what kind of update it was
+            recorded.update((kind, {}) for kind in update if kind != 'update_id')
+            chat_id = 0
+
+        # whole chats are in or out, so their bursts stay the same
+        if self.sample < 1 and abs(chat_id) % 10000 >= self.sample * 10000:
+            return None
+
+        return dict(t=round(time.time(), 3), update=recorded)
+
+    def write(self, entry, answers):
+        entry['answers'] = answers
+
+        try:
+            self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self.recorded += 1
+
+            now = time.monotonic()
+
+            if now - self._flushed > self._flush_every:
+                self._file.flush()
+                self._flushed = now
+        except (OSError, ValueError):
+            self._logger.exception('Could not record update %s', entry['update'].get('update_id'))
+
+    def close(self):
+        self._file.close()
+        self._logger.info('Recorded %s updates to %s', self.recorded, self.path)
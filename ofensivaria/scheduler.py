@@ -0,0 +1,150 @@
+import time
+import uuid
+import random
+import asyncio
+import logging
+
+from ofensivaria import config
+
+
+def job(interval, jitter=0, timeout=None, overlap=False, lock=True, warm_up=True):
+    """ Marks a command method as a job the scheduler runs every `interval`
+    seconds, give or take `jitter`.
+
+    timeout -- seconds a run may take, defaults to the interval
+    overlap -- if a run may start while the previous one is still going
+    lock -- if the job runs once per interval across every bot process, or
+            in each one of them
+    warm_up -- if the first run happens right after starting, instead of
+               after the first interval """
+
+    def decorate(f):
+        f.job = dict(interval=interval, jitter=jitter, timeout=timeout, overlap=overlap, lock=lock,
+                     warm_up=warm_up)
+        return f
+
+    return decorate
+
+
+class Job:
+
+    def __init__(self, name, func, interval, jitter=0, timeout=None, overlap=False, lock=True, warm_up=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout or interval
+        self.overlap = overlap
+        self.lock = lock
+        self.warm_up = warm_up
+        self.running = 0
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.last_error = None
+
+    def stats(self):
+        return dict(runs=self.runs, failures=self.failures, skipped=self.skipped, running=self.running,
+                    last_duration=self.last_duration, last_error=self.last_error)
+
+
+class Scheduler:
+    """ Runs the periodic jobs commands declare with @job.
+
+    Locked jobs take a redis lock that lasts for their interval before running,
+    so in a given interval only one of the bot processes runs them. The lock is
+    given back if the run fails, so someone else can try again. """
+
+    LOCK_KEY = 'bot:jobs:%s:lock'
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+
+        return 0
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._jobs = {}
+        self._tasks = []
+        self._logger = logging.getLogger('scheduler')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @property
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def add(self, name, func, interval, **kwargs):
+        self._jobs[name] = Job(name, func, interval, **kwargs)
+
+    def discover(self, command):
+        cls = type(command)
+
+        for attribute in dir(cls):
+            spec = getattr(getattr(cls, attribute), 'job', None)
+
+            if isinstance(spec, dict):
+                self.add('%s.%s' % (cls.__name__, attribute), getattr(command, attribute), **spec)
+
+    def start(self):
+        for job in self._jobs.values():
+            self._tasks.append(asyncio.ensure_future(self.__loop(job)))
+
+    async def __loop(self, job):
+        delay = job.interval if not job.warm_up else 0
+        delay += random.uniform(0, job.jitter) if job.jitter else 0
+
+        while True:
+            await asyncio.sleep(delay)
+            delay = max(0, job.interval + random.uniform(-job.jitter, job.jitter))
+
+            if job.running and not job.overlap:
+                job.skipped += 1
+                self._logger.warning('Skipping %s, the last run is still going', job.name)
+                continue
+
+            self._tasks.append(asyncio.ensure_future(self.run(job)))
+            self._tasks = [t for t in self._tasks if not t.done()]
+
+    async def run(self, job):
+        key = self.LOCK_KEY % job.name
+        token = uuid.uuid4().hex
+
+        if job.lock:
+            ttl = int(max(1, job.interval - job.jitter) * 1000)
+            locked = await self._redis.set(key, token, pexpire=ttl, exist=self._redis.SET_IF_NOT_EXIST)
+
+            if not locked:
+                job.skipped += 1
+                return
+
+        job.running += 1
+        start = time.monotonic()
+
+        try:
+            await asyncio.wait_for(job.func(), job.timeout)
+            job.runs += 1
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = repr(e)
+            self._logger.exception('Job %s failed', job.name)
+
+            if job.lock:
+                await self._redis.eval(self.RELEASE_SCRIPT, keys=[key], args=[token])
+        finally:
+            job.running -= 1
+            job.last_duration = time.monotonic() - start
+            self._logger.debug('Job %s took %.3fs', job.name, job.last_duration)
+
+    def stats(self):
+        return {job.name: job.stats() for job in self._jobs.values()}
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
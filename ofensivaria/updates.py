@@ -0,0 +1,111 @@
+import heapq
+import logging
+
+from ofensivaria import config
+
+
+class UpdateStore:
+    """ Remembers which updates were already processed.
+
+    Instead of keeping every update id forever, we keep the highest id we've
+    seen (the watermark, which is also the next getUpdates offset) and the ids
+    inside a window right below it, for webhook deliveries that arrive out of
+    order. Anything older than the window counts as processed. """
+
+    OFFSET_KEY = 'bot:updates:offset'
+    RECENT_KEY = 'bot:updates:recent'
+    LEGACY_KEY = 'bot:updates'
+
+    SET_MAX_SCRIPT = """
+        local current = tonumber(redis.call('get', KEYS[1]) or '0')
+
+        if tonumber(ARGV[1]) > current then
+            redis.call('set', KEYS[1], ARGV[1])
+        end
+    """
+
+    def __init__(self, redis, window=1000):
+        self._redis = redis
+        self._window = window
+        self._recent = set()
+        self._heap = []
+        self.watermark = 0
+        self._logger = logging.getLogger('updates')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @property
+    def offset(self):
+        return self.watermark + 1 if self.watermark else None
+
+    @property
+    def floor(self):
+        return self.watermark - self._window
+
+    async def load(self):
+        if await self._redis.exists(self.LEGACY_KEY):
+            await self.__migrate()
+
+        watermark = await self._redis.get(self.OFFSET_KEY)
+        self.watermark = int(watermark) if watermark else 0
+
+        recent = await self._redis.zrangebyscore(self.RECENT_KEY, self.floor + 1, self.watermark)
+        self.__remember(*map(int, recent))
+
+    async def __migrate(self):
+        ids = sorted(map(int, await self._redis.smembers(self.LEGACY_KEY)))
+        self._logger.info('Migrating %s processed updates from %s', len(ids), self.LEGACY_KEY)
+
+        if ids:
+            recent = [i for i in ids if i > ids[-1] - self._window]
+            pairs = [value for i in recent for value in (i, i)]
+
+            transaction = self._redis.multi_exec()
+            transaction.eval(self.SET_MAX_SCRIPT, keys=[self.OFFSET_KEY], args=[ids[-1]])
+            transaction.zadd(self.RECENT_KEY, *pairs)
+            transaction.delete(self.LEGACY_KEY)
+            await transaction.execute()
+        else:
+            await self._redis.delete(self.LEGACY_KEY)
+
+    def __remember(self, *ids):
+        for id in ids:
+            if id in self._recent:
+                continue
+
+            self._recent.add(id)
+            heapq.heappush(self._heap, id)
+            self.watermark = max(self.watermark, id)
+
+        floor = self.floor
+
+        while self._heap and self._heap[0] <= floor:
+            self._recent.discard(heapq.heappop(self._heap))
+
+    def seen(self, id):
+        return id <= self.floor or id in self._recent
+
+    async def mark(self, id):
+        """ Marks the update as processed. Returns False if some other process
+        got to it first """
+        return id in await self.mark_many([id])
+
+    async def mark_many(self, ids):
+        """ Marks a batch of updates in a single transaction. Returns the ids
+        no other process had marked yet """
+        if not ids:
+            return set()
+
+        self.__remember(*ids)
+
+        transaction = self._redis.multi_exec()
+        added = [(id, transaction.zadd(self.RECENT_KEY, id, id)) for id in ids]
+        transaction.zremrangebyscore(self.RECENT_KEY, max=self.floor)
+        transaction.eval(self.SET_MAX_SCRIPT, keys=[self.OFFSET_KEY], args=[self.watermark])
+        await transaction.execute()
+
+        return {id for id, future in added if await future}
+
+    async def unmark(self, id):
+        """ Forgets the update was processed, so it's taken when delivered again """
+        self._recent.discard(id)
+        await self._redis.zrem(self.RECENT_KEY, id)
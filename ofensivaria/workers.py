@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from collections import deque
+
+from ofensivaria import config
+
+
+class ChatWorkerPool:
+    """ Processes updates from different chats concurrently while keeping the
+    updates of a single chat in the order they were submitted.
+
+    Every chat with pending updates gets its own queue and a task draining it.
+    `concurrency` limits how many updates are being handled at the same time
+    and `max_pending` how many can be waiting, across all chats. """
+
+    def __init__(self, handler, concurrency, max_pending=1000):
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._space = asyncio.Event()
+        self._max_pending = max_pending
+        self._queues = {}
+        self._tasks = {}
+        self._pending = 0
+        self._in_flight = 0
+        self._logger = logging.getLogger('workers')
+        self._logger.setLevel(config.LOGGING_LEVEL)
+
+    @property
+    def queue_depth(self):
+        return self._pending - self._in_flight
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def is_full(self):
+        return self._pending >= self._max_pending
+
+    def stats(self):
+        return dict(queued=self.queue_depth, in_flight=self.in_flight, chats=len(self._queues))
+
+    @staticmethod
+    def chat_key(update):
+        try:
+            return update['message']['chat']['id']
+        except (KeyError, TypeError):
+            pass
+
+        try:
+            return 'inline:%s' % update['inline_query']['from']['id']
+        except (KeyError, TypeError):
+            return None
+
+    async def submit(self, update):
+        while self.is_full:
+            self._space.clear()
+            await self._space.wait()
+
+        self.__enqueue(update)
+
+    def try_submit(self, update):
+        """ Like submit, but returns False instead of waiting when full """
+        if self.is_full:
+            return False
+
+        self.__enqueue(update)
+        return True
+
+    def __enqueue(self, update):
+        chat = self.chat_key(update)
+
+        self._pending += 1
+        self._queues.setdefault(chat, deque()).append(update)
+
+        if chat not in self._tasks:
+            self._tasks[chat] = asyncio.ensure_future(self.__drain(chat))
+
+    async def __drain(self, chat):
+        queue = self._queues[chat]
+
+        try:
+            while queue:
+                update = queue.popleft()
+
+                async with self._semaphore:
+                    self._in_flight += 1
+
+                    try:
+                        await self._handler(update)
+                    except Exception as e:
+                        self._logger.exception(e)
+                    finally:
+                        self._in_flight -= 1
+                        self._pending -= 1
+                        self._space.set()
+        finally:
+            del self._queues[chat]
+            del self._tasks[chat]
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+
+        for task in tasks:
+            task.cancel()
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
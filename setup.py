@@ -17,7 +17,7 @@ setup(
 
     provides=['ofensivaria'],
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
 
     entry_points={
@@ -44,6 +44,7 @@ setup(
             'mtg = ofensivaria.commands:MtgCard',
             'excuse = ofensivaria.commands:ProgrammerExcuses',
             'magic_eightball = ofensivaria.commands:MagicEightBall',
+            'profile = ofensivaria.commands:Profile',
         ],
     },
 